@@ -13,8 +13,22 @@ import json
 from PIL import Image, ImageDraw, ImageFont, ImageTk
 import io
 import socket
+import sqlite3
 import math
 import platform
+import itertools
+import uuid
+import re
+import hashlib
+import struct
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+
+try:
+    import av
+except ImportError:
+    av = None
 
 os_name = platform.system()
 
@@ -25,12 +39,18 @@ if os_name == "Windows":
 
     VIDEO_FOLDER = os.path.join(APP_PATH, "Videos")
     CONFIG_FILE  = os.path.join(APP_PATH, "config.json")
+    UPLOAD_JOURNAL = os.path.join(APP_PATH, "upload_queue.json")
+    PACKAGING_DB   = os.path.join(APP_PATH, "packaging.db")
     os.makedirs(VIDEO_FOLDER, exist_ok=True)
 
 elif os_name == "Darwin":
     print("Running on macOS")
     VIDEO_FOLDER = "Videos"
     CONFIG_FILE  = "config.json"
+    UPLOAD_JOURNAL = "upload_queue.json"
+    PACKAGING_DB   = "packaging.db"
+
+QUARANTINE_FOLDER = os.path.join(VIDEO_FOLDER, "quarantine")
 
 
 # ─────────────────────────────────────────────
@@ -38,6 +58,22 @@ elif os_name == "Darwin":
 # ─────────────────────────────────────────────
 SETTINGS_PASSWORD = "1234"
 LOGO_PATH = "logo.png"
+PRE_BUFFER_JPEG_QUALITY = 80
+PRE_BUFFER_PENDING_MAX  = 8     # raw frames allowed to wait for the JPEG encoder
+WRITER_OUTBOX_FRAMES    = 4     # live frames allowed to wait for a shared-ring slot
+PACKET_SLOT_DIVISOR     = 6     # passthrough slots are this much smaller than a raw frame
+PREVIEW_SIZE = (330, 200)
+REC_TINT_ALPHA = 18 / 255
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_RETRY_MAX  = 300     # seconds; retry backoff doubles up to this
+UPLOAD_CONFLICT_MAX = 3     # offset mismatches in a row before an attempt gives up
+LOCAL_SWEEP_INTERVAL = 3600 # seconds between sweeps of stale local videos
+LIVE_ID_WAIT = 10           # seconds a live segment waits for its record's server id
+LIVE_MAX_LAG = 60           # seconds after which an unsent live segment is skipped
+API_BREAKER_FAILURES = 3    # consecutive failures that open the breaker
+API_BREAKER_COOLDOWN = 15   # seconds before a probe call is let through
+SYNC_BATCH_SIZE = 100
+VIDEO_FOURCC = "H264"
 
 DEFAULT_CONFIG = {
     "workstation_name": "",
@@ -47,6 +83,15 @@ DEFAULT_CONFIG = {
     "post_buffer_duration": 5,
     "video_quality": "High",
     "video_save_path": "Videos",
+    "pre_buffer_encoding": "jpeg",
+    "recording_mode": "encode",
+    "preview_url": "",
+    "preview_fps": 10,
+    "cameras": [],
+    "upload_workers": 1,
+    "upload_kbps": 0,
+    "local_retention_days": 14,
+    "live_segment_seconds": 4,
     "api_base": "http://192.168.0.135:27189",
     "system_ip": "",
     "ws_id": 0,
@@ -141,28 +186,20 @@ def parse_api_base(api_base):
 # ─────────────────────────────────────────────
 
 config = load_config() or DEFAULT_CONFIG.copy()
-pre_buffer = deque(maxlen=config.get('pre_buffer_duration', 5) * config.get('frame_rate', 30))
 recording = True
-cap = None
-frame_width = 640
-frame_height = 480
-barcode_value = None
-is_recording = False
-current_packaging_id = None
-frame_queue = Queue(maxsize=300)
+stations = []
+open_sessions = set()
+sessions_lock = threading.Lock()
+finalize_queue = Queue()
 app_running = True
-current_writer = None
-current_output_file = None
-writer_lock = threading.Lock()
 task_lock = threading.Lock()
 last_barcode_1 = ""
 last_barcode_2 = ""
 gui = None
 dialog_open = False
-
-# Live preview shared frame
-preview_frame = None
-preview_lock = threading.Lock()
+upload_queue = None
+live_uploader = None
+packaging_journal = None
 
 # ─────────────────────────────────────────────
 #  WIDGET HELPERS
@@ -513,7 +550,8 @@ class ConfigSetupGUI:
 
     def _save(self):
         global config
-        new = {}
+        # Start from the current config so keys without a field survive
+        new = dict(config)
         placeholder_keys = {"rtsp_url", "workstation_name"}
 
         for key, e in self.entries.items():
@@ -546,7 +584,6 @@ class ConfigSetupGUI:
         new["api_base"] = f"http://{srv_ip}:{srv_port}"
 
         new['video_quality']  = self.quality_var.get()
-        new['video_save_path'] = config.get('video_save_path', 'Videos')
         new['system_ip'] = get_system_ip()
 
         ws_id = create_workstation_api(new)
@@ -594,7 +631,7 @@ class SettingsDialog:
         return win, _close
 
     def _ask_password(self):
-        if is_recording:
+        if any_recording():
             messagebox.showwarning(
                 "Recording Active",
                 "Settings cannot be changed while recording.\nFinish the current recording first.",
@@ -753,7 +790,8 @@ class SettingsDialog:
 
         def do_save():
             global config, dialog_open
-            new = {}
+            # Start from the current config so keys without a field survive
+            new = dict(config)
             for key, e in self._ents.items():
                 v = e.get().strip()
                 if not v:
@@ -780,7 +818,6 @@ class SettingsDialog:
             new["api_base"] = f"http://{srv_ip}:{srv_port}"
 
             new['video_quality']   = self._qv.get()
-            new['video_save_path'] = config.get('video_save_path', 'Videos')
             new['system_ip']       = get_system_ip()
 
             r = update_workstation_api(config['ws_id'], new)
@@ -823,6 +860,7 @@ class VideoRecorderGUI:
         self._blink_state = True
         self._blink_job   = None
         self._preview_job = None
+        self.active_station = None
 
         # Treeview style
         style = ttk.Style()
@@ -984,6 +1022,8 @@ class VideoRecorderGUI:
             ("video_quality",      "QUALITY",    "val"),
             ("pre_buffer_duration","PRE-BUF",    "sec"),
             ("post_buffer_duration","POST-BUF",  "sec"),
+            ("pre_buffer_encoding","PRE-ENC",    "val"),
+            ("recording_mode",     "MODE",       "val"),
             ("api_base",           "SERVER",     "url"),
             ("system_ip",          "LOCAL IP",   "ip"),
             ("ws_id",              "WS-ID",      "id"),
@@ -1037,7 +1077,8 @@ class VideoRecorderGUI:
 
         self._sr = {}
         for key, lbl in [("pkg_id", "PKG-ID"), ("barcode1", "ORDER"),
-                          ("barcode2", "B-CODE 2"), ("frames", "FRAMES")]:
+                          ("barcode2", "B-CODE 2"), ("frames", "FRAMES"),
+                          ("encode", "ENCODE")]:
             row = tk.Frame(cfg_scroll, bg=C["bg2"])
             row.pack(fill=tk.X, padx=10, pady=2)
             tk.Label(row, text=lbl,
@@ -1092,7 +1133,7 @@ class VideoRecorderGUI:
         cols = ('ID', 'Order ID', 'Barcode 2', 'Status', 'Timestamp')
         self.task_tree = ttk.Treeview(tbl_frame, columns=cols,
                                        show='headings', style='Pkg.Treeview')
-        for col, w in zip(cols, [80, 170, 170, 120, 190]):
+        for col, w in zip(cols, [100, 170, 150, 120, 190]):
             self.task_tree.heading(col, text=col.upper())
             self.task_tree.column(col, width=w, minwidth=60, anchor=tk.W)
 
@@ -1100,6 +1141,7 @@ class VideoRecorderGUI:
         self.task_tree.tag_configure('uploading', foreground=C["warn"])
         self.task_tree.tag_configure('completed', foreground=C["accent"])
         self.task_tree.tag_configure('failed',    foreground=C["danger"])
+        self.task_tree.tag_configure('queued',    foreground=C["text2"])
 
         sb = ttk.Scrollbar(tbl_frame, orient=tk.VERTICAL, command=self.task_tree.yview)
         self.task_tree.configure(yscrollcommand=sb.set)
@@ -1136,66 +1178,86 @@ class VideoRecorderGUI:
         self._update_preview()
 
     def _update_preview(self):
-        global preview_frame
         try:
             if not self.root.winfo_exists():
                 return
-            with preview_lock:
-                frame = preview_frame
 
             w = self.cam_canvas.winfo_width()  or 330
             h = self.cam_canvas.winfo_height() or 200
 
-            if frame is not None:
-                # Convert BGR → RGB, resize to canvas
-                rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                img = Image.fromarray(rgb)
-                img = img.resize((w, h), Image.Resampling.LANCZOS)
-
-                # If recording, tint with subtle red overlay
-                if is_recording:
-                    overlay = Image.new("RGBA", img.size, (255, 0, 0, 18))
-                    img = img.convert("RGBA")
-                    img = Image.alpha_composite(img, overlay).convert("RGB")
-
-                self._cam_photo = ImageTk.PhotoImage(img)
-                self.cam_canvas.delete("all")
+            # One tile per camera, laid out as a near-square grid
+            n = max(len(stations), 1)
+            cols = math.ceil(math.sqrt(n))
+            rows = math.ceil(n / cols)
+            tw, th = max(w // cols, 1), max(h // rows, 1)
+            tiles = []
+            for i, st in enumerate(stations or [None]):
+                x, y = (i % cols) * tw, (i // cols) * th
+                ring = st.frame_ring if st else None
+                if ring:
+                    # Capture scales and tints the next preview to suit this tile
+                    ring.preview_size = (tw, th)
+                    ring.preview_tint = st.is_recording
+                tiles.append((st, x, y, ring.preview() if ring else None))
+
+            self.cam_canvas.delete("all")
+            if any(f is not None for _, _, _, f in tiles):
+                canvas_img = Image.new("RGB", (w, h), C["cam_bg"])
+                for st, x, y, frame in tiles:
+                    if frame is None:
+                        continue
+                    # Already RGB, tile-sized and tinted by the capture thread
+                    img = Image.fromarray(frame)
+                    if img.size != (tw, th):
+                        # Window was resized; the next preview will match
+                        img = img.resize((tw, th), Image.Resampling.NEAREST)
+                    canvas_img.paste(img, (x, y))
+
+                self._cam_photo = ImageTk.PhotoImage(canvas_img)
                 self.cam_canvas.create_image(0, 0, anchor=tk.NW, image=self._cam_photo)
+                self.cam_status_dot.config(fg=C["accent"])
+            else:
+                self.cam_canvas.create_rectangle(
+                    0, 0, w, h, fill=C["cam_bg"], outline="")
+                self.cam_status_dot.config(fg=C["text3"])
+
+            for st, x, y, frame in tiles:
+                if frame is None:
+                    # No feed — show placeholder
+                    self.cam_canvas.create_text(
+                        x + tw // 2, y + th // 2,
+                        text="◉  NO FEED",
+                        font=("Consolas", 12 if n == 1 else 8), fill=C["text3"])
 
                 # REC badge overlay when recording
-                if is_recording:
+                if st and st.is_recording:
                     self.cam_canvas.create_rectangle(
-                        w - 70, 8, w - 6, 26,
+                        x + tw - 70, y + 8, x + tw - 6, y + 26,
                         fill=C["rec_dim"], outline=C["rec"], width=1)
                     self.cam_canvas.create_text(
-                        w - 38, 17,
+                        x + tw - 38, y + 17,
                         text="⏺  REC",
                         font=("Consolas", 8, "bold"),
                         fill=C["rec"])
 
-                # Timestamp overlay
-                ts = datetime.datetime.now().strftime("%H:%M:%S")
-                self.cam_canvas.create_text(
-                    8, h - 8, anchor=tk.SW,
-                    text=ts, font=("Consolas", 8),
-                    fill=C["text3"])
+                if n > 1 and st:
+                    self.cam_canvas.create_text(
+                        x + 6, y + 6, anchor=tk.NW,
+                        text=st.name, font=("Consolas", 8, "bold"),
+                        fill=C["accent"] if st is self.active_station else C["text2"])
 
-                self.cam_status_dot.config(fg=C["accent"])
-            else:
-                # No feed — show placeholder
-                self.cam_canvas.delete("all")
-                self.cam_canvas.create_rectangle(
-                    0, 0, w, h, fill=C["cam_bg"], outline="")
-                self.cam_canvas.create_text(
-                    w // 2, h // 2,
-                    text="◉  NO FEED",
-                    font=("Consolas", 12), fill=C["text3"])
-                self.cam_status_dot.config(fg=C["text3"])
+            # Timestamp overlay
+            ts = datetime.datetime.now().strftime("%H:%M:%S")
+            self.cam_canvas.create_text(
+                8, h - 8, anchor=tk.SW,
+                text=ts, font=("Consolas", 8),
+                fill=C["text3"])
 
         except Exception as e:
             pass
 
-        self._preview_job = self.root.after(40, self._update_preview)  # ~25 fps
+        fps = max(config.get('preview_fps', 10), 1)
+        self._preview_job = self.root.after(int(1000 / fps), self._update_preview)
 
     # ── Refresh config readout ────────────────
 
@@ -1212,11 +1274,13 @@ class VideoRecorderGUI:
         SettingsDialog(self.root)
 
     def on_barcode_enter(self, event):
-        global barcode_value, last_barcode_1, last_barcode_2
+        global last_barcode_1, last_barcode_2
         code = self.barcode_entry.get().strip()
-        if code:
-            barcode_value = code
-            if not is_recording:
+        if code and stations:
+            st, code = route_barcode(code)
+            self.active_station = st
+            st.barcode_queue.put(code)
+            if not st.is_recording:
                 last_barcode_1 = code
                 self.last_bc_lbl.configure(text=code, fg=C["accent3"])
                 self.scan_sub.configure(text="scan #1 received — starting…", fg=C["accent"])
@@ -1225,7 +1289,7 @@ class VideoRecorderGUI:
                 self.last_bc_lbl.configure(text=code, fg=C["warn"])
                 self.scan_sub.configure(text="scan #2 received — stopping…", fg=C["warn"])
             self.barcode_entry.delete(0, tk.END)
-            self.log(f"Barcode scanned: {code}", "info")
+            st.log(f"Barcode scanned: {code}", "info")
             self.barcode_entry.focus_set()
 
     def update_status(self, text, state="idle"):
@@ -1270,9 +1334,10 @@ class VideoRecorderGUI:
             self._blink_job = None
 
     def update_current_info(self, packaging_id=None, barcode1=None,
-                             barcode2=None, frames=None):
+                             barcode2=None, frames=None, encode=None):
         for key, val in [("pkg_id", packaging_id), ("barcode1", barcode1),
-                          ("barcode2", barcode2),   ("frames",   frames)]:
+                          ("barcode2", barcode2),   ("frames",   frames),
+                          ("encode",   encode)]:
             if val is not None:
                 self._sr[key].configure(text=str(val))
 
@@ -1282,7 +1347,11 @@ class VideoRecorderGUI:
                 td['status'], td['time'])
         with task_lock:
             for item in self.task_tree.get_children():
-                if self.task_tree.item(item)['values'][0] == td['id']:
+                old = self.task_tree.item(item)['values']
+                if str(old[0]) == str(td['id']):
+                    # Status updates keep the barcodes already shown
+                    vals = (old[0], td.get('barcode1', old[1]),
+                            td.get('barcode2', old[2]), td['status'], td['time'])
                     self.task_tree.item(item, values=vals, tags=(tag,))
                     return
             self.task_tree.insert('', 0, values=vals, tags=(tag,))
@@ -1311,10 +1380,87 @@ class VideoRecorderGUI:
 #  API CALLS
 # ─────────────────────────────────────────────
 
+class ApiUnavailable(requests.ConnectionError):
+    pass
+
+class ApiClient:
+    """One keep-alive connection pool for every call to the server.
+
+    Calls are timed per endpoint (`stats()`). After API_BREAKER_FAILURES
+    consecutive connection errors or 5xx replies the breaker opens and
+    calls fail at once with ApiUnavailable instead of each waiting out its
+    timeout; after API_BREAKER_COOLDOWN one probe call is let through and
+    its outcome closes or reopens the breaker.
+    """
+    def __init__(self):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=8)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._lock       = threading.Lock()
+        self._failures   = 0
+        self._open_until = 0.0
+        self._stats      = {}
+
+    def request(self, method, path, base=None, **kw):
+        now = time.time()
+        with self._lock:
+            if self._failures >= API_BREAKER_FAILURES:
+                if now < self._open_until:
+                    raise ApiUnavailable("server unavailable — retrying shortly")
+                # Half-open: this call is the probe, the rest keep failing fast
+                self._open_until = now + API_BREAKER_COOLDOWN
+        name = f"{method} {re.sub(r'/[0-9]+', '/<id>', path)}"
+        kw.setdefault("timeout", 10)
+        t0 = time.perf_counter()
+        try:
+            res = self.session.request(method, f"{base or config.get('api_base')}{path}", **kw)
+            failed = res.status_code >= 500
+            return res
+        except requests.RequestException:
+            failed = True
+            raise
+        finally:
+            self._record(name, (time.perf_counter() - t0) * 1000, failed)
+
+    def _record(self, name, ms, failed):
+        with self._lock:
+            s = self._stats.setdefault(name, {"calls": 0, "errors": 0,
+                                              "total_ms": 0.0, "max_ms": 0.0})
+            s["calls"]    += 1
+            s["errors"]   += failed
+            s["total_ms"] += ms
+            s["max_ms"]    = max(s["max_ms"], ms)
+            if not failed:
+                self._failures = 0
+                return
+            self._failures += 1
+            if self._failures == API_BREAKER_FAILURES:
+                print(f"API breaker open: {self._failures} failures in a row")
+            if self._failures >= API_BREAKER_FAILURES:
+                self._open_until = time.time() + API_BREAKER_COOLDOWN
+
+    def available(self):
+        """False while the breaker is open and its cooldown is still running."""
+        with self._lock:
+            return self._failures < API_BREAKER_FAILURES or time.time() >= self._open_until
+
+    def stats(self):
+        with self._lock:
+            return {name: {"calls": s["calls"], "errors": s["errors"],
+                           "avg_ms": round(s["total_ms"] / s["calls"], 1),
+                           "max_ms": round(s["max_ms"], 1)}
+                    for name, s in self._stats.items()}
+
+    def close(self):
+        self.session.close()
+
+api = ApiClient()
+
 def create_workstation_api(cfg):
     try:
-        res = requests.post(f"{cfg['api_base']}/api/workstation/create",
-                            json=cfg, timeout=10)
+        res = api.request("POST", "/api/workstation/create", base=cfg['api_base'],
+                          json=cfg)
         if res.status_code == 201:
             wid = res.json()["workstation_id"]
             print(f"workstation created: {wid}")
@@ -1327,247 +1473,1812 @@ def create_workstation_api(cfg):
 
 def update_workstation_api(ws_id, cfg):
     try:
-        requests.put(f"{cfg['api_base']}/api/workstation/update/{ws_id}",
-                     json=cfg, timeout=10)
+        api.request("PUT", f"/api/workstation/update/{ws_id}", base=cfg['api_base'],
+                    json=cfg)
         print(f"workstation updated: {ws_id}")
         return True
     except Exception as e:
         print(f"Update error: {e}")
         return f"Update error: {e}"
 
-def create_packaging_api(barcode1):
+def packaging_batch_api(events):
+    """Send create/update events in one request. Returns the per-event results.
+
+    None means the batch didn't go through; try again later. That includes
+    a 4xx for the whole request (expired token, rate limit, a server
+    without the batch endpoint): only a per-event result is final.
+    """
     try:
-        res = requests.post(f"{config.get('api_base')}/api/packaging/create",
-                            json={"bar_code_1": barcode1, "ws_id": config['ws_id']},
-                            timeout=10)
-        if res.status_code == 201:
-            pid = res.json()["packaging_id"]
-            gui.log(f"Packaging created: {pid}", "ok")
-            gui.add_task({'id': pid, 'barcode1': barcode1, 'status': 'Recording',
-                          'time': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
-            return pid
-        gui.log(f"Create failed: {res.text}", "err")
+        res = api.request("POST", "/api/packaging/batch", json={"events": events})
+        if res.status_code == 200:
+            return res.json()["results"]
+        gui.log(f"Sync failed ({res.status_code}): {res.text}", "err")
         return None
     except Exception as e:
         gui.log(f"API Error: {e}", "err")
         return None
 
-def update_packaging_api(packaging_id, barcode2):
+def upload_video_api(packaging_id, video_path, upload_id, throttle=None):
+    """Send the video in chunks, resuming from whatever the server already holds.
+
+    The file's hash goes first: if the server already stores those bytes
+    it attaches them and nothing is sent.
+    """
+    path = f"/api/packaging/upload-chunk/{packaging_id}"
+    size = os.path.getsize(video_path)
+    sha256 = hashlib.sha256()
+    with open(video_path, "rb") as f:
+        for block in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            sha256.update(block)
+    params = {"upload_id": upload_id, "filename": os.path.basename(video_path),
+              "total": size, "sha256": sha256.hexdigest()}
     try:
-        requests.put(f"{config.get('api_base')}/api/packaging/update/{packaging_id}",
-                     json={"bar_code_2": barcode2,
-                           "end_time": datetime.datetime.now().isoformat()},
-                     timeout=10)
-        gui.log(f"Packaging updated: {packaging_id}", "ok")
-        gui.add_task({'id': packaging_id, 'barcode2': barcode2, 'status': 'Uploading',
-                      'time': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
-    except Exception as e:
-        gui.log(f"Update error: {e}", "err")
-
-def upload_video_api(packaging_id, video_path):
-    try:
-        gui.log(f"Uploading video for {packaging_id}…", "warn")
+        res = api.request("GET", path, params=params)
+        if res.status_code != 200:
+            gui.log(f"Upload failed: {res.text}", "err")
+            return False
+        body = res.json()
+        offset = body.get('offset', 0)
+        if body.get('deduplicated'):
+            gui.log(f"Video for {packaging_id} already on server", "ok")
+        if not body.get('complete'):
+            gui.log(f"Uploading video for {packaging_id}"
+                    + (f" from {offset * 100 // size}%…" if offset else "…"), "warn")
+        conflicts = 0
         with open(video_path, "rb") as f:
-            res = requests.post(
-                f"{config.get('api_base')}/api/packaging/upload-video/{packaging_id}",
-                files={"video": f}, timeout=120)
-        if res.status_code == 200:
-            gui.log(f"Video uploaded: {packaging_id}", "ok")
-            gui.add_task({'id': packaging_id, 'status': 'Completed',
-                          'time': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
-            return True
-        gui.log(f"Upload failed: {res.text}", "err")
-        return False
+            # Only a reply saying the server attached the file ends the loop;
+            # an empty chunk at the end asks it to retry a failed attach
+            while not body.get('complete'):
+                if not app_running:
+                    return False
+                f.seek(offset)
+                chunk = f.read(UPLOAD_CHUNK_SIZE)
+                if throttle:
+                    throttle(len(chunk))
+                res = api.request("POST", path, params={**params, "offset": offset},
+                                  data=chunk, timeout=30,
+                                  headers={"Content-Type": "application/octet-stream"})
+                if res.status_code == 409:
+                    # Server holds a different amount than we thought; go from
+                    # there, unless it keeps moving (another sender, a bad part)
+                    conflicts += 1
+                    if conflicts > UPLOAD_CONFLICT_MAX:
+                        gui.log(f"Upload failed: offset keeps changing for {packaging_id}", "err")
+                        return False
+                    offset = res.json().get('offset', 0)
+                    continue
+                if res.status_code != 200:
+                    gui.log(f"Upload failed: {res.text}", "err")
+                    return False
+                conflicts = 0
+                body = res.json()
+                offset += len(chunk)
+                if offset >= size and not body.get('complete'):
+                    gui.log(f"Upload failed: server did not confirm {packaging_id}", "err")
+                    return False
+        gui.log(f"Video uploaded: {packaging_id}", "ok")
+        return True
     except Exception as e:
         gui.log(f"Upload error: {e}", "err")
         return False
 
 # ─────────────────────────────────────────────
-#  FRAME WRITER THREAD
+#  FRAME RING
 # ─────────────────────────────────────────────
 
-def frame_writer_thread():
-    while app_running:
-        try:
-            try:
-                fd = frame_queue.get(timeout=1)
-            except Empty:
+class FrameRing:
+    """Timestamped ring of the most recent camera frames.
+
+    The capture thread is the only producer. Attached sinks (recording
+    sessions) are offered every new frame without blocking; a sink that
+    returns False has reached the end of its window and is dropped.
+
+    With `jpeg_quality` set, the ring keeps the pre-roll as JPEG packets
+    (a 1-D uint8 array per frame) instead of raw BGR frames. Encoding runs
+    on a helper thread so capture never waits on it; the writer thread
+    decodes packets when a session splices the pre-roll into its file.
+    At most PRE_BUFFER_PENDING_MAX raw frames wait for the encoder; if it
+    falls further behind the oldest waiting frame is dropped from the
+    pre-roll and counted in `dropped`, so memory stays bounded.
+
+    The GUI never sees full frames. At most `preview_fps` times a second
+    the producer shrinks a frame to `preview_size`, converts it to RGB and
+    tints it while `preview_tint` is set; `preview()` returns that image.
+    """
+    def __init__(self, maxlen, jpeg_quality=None, preview_fps=10):
+        self._buf    = deque(maxlen=maxlen)
+        self._lock   = threading.Lock()
+        self._sinks  = []
+        self._preview = None
+        self._preview_ts = 0.0
+        self._preview_every = 1.0 / preview_fps if preview_fps else 0.0
+        self._tint = None
+        self.preview_size = PREVIEW_SIZE
+        self.preview_tint = False
+        self._quality = jpeg_quality
+        self.dropped  = 0
+        if jpeg_quality:
+            self._pending = deque()
+            self._wake    = threading.Event()
+            threading.Thread(target=self._encode_loop, daemon=True).start()
+
+    def push(self, frame, ts=None):
+        ts = ts or time.time()
+        self.set_preview(frame, ts)
+        with self._lock:
+            if self._quality:
+                if len(self._pending) >= PRE_BUFFER_PENDING_MAX:
+                    self._pending.popleft()
+                    self.dropped += 1
+                self._pending.append((ts, frame))
+            else:
+                self._buf.append((ts, frame))
+            for sink in list(self._sinks):
+                if not sink.offer(frame, ts):
+                    self._sinks.remove(sink)
+                    sink.tail_done.set()
+        if self._quality:
+            self._wake.set()
+
+    def _encode_loop(self):
+        params = [cv2.IMWRITE_JPEG_QUALITY, self._quality]
+        while app_running:
+            if not self._wake.wait(1):
                 continue
-            if fd is None:
-                break
-            with writer_lock:
-                if current_writer:
-                    current_writer.write(fd[1])
+            self._wake.clear()
+            while True:
+                with self._lock:
+                    if not self._pending:
+                        break
+                    ts, frame = self._pending[0]
+                ok, packet = cv2.imencode(".jpg", frame, params)
+                with self._lock:
+                    # clear() may have emptied the queue while we were encoding
+                    if self._pending and self._pending[0][0] == ts:
+                        self._pending.popleft()
+                        if ok:
+                            self._buf.append((ts, packet))
+
+    def set_preview(self, frame, ts=None):
+        """Publish a preview-sized copy of `frame` unless one went out recently."""
+        ts = ts or time.time()
+        if ts - self._preview_ts < self._preview_every:
+            return
+        self._preview_ts = ts
+        # The preview is a side job of the capture thread; it must never stop it
+        try:
+            w, h = self.preview_size
+            small = cv2.resize(frame, (max(int(w), 1), max(int(h), 1)),
+                               interpolation=cv2.INTER_AREA)
+            cv2.cvtColor(small, cv2.COLOR_BGR2RGB, dst=small)
+            if self.preview_tint:
+                if self._tint is None or self._tint.shape != small.shape:
+                    self._tint = np.full(small.shape, (255, 0, 0), np.uint8)
+                cv2.addWeighted(small, 1 - REC_TINT_ALPHA, self._tint, REC_TINT_ALPHA,
+                                0, dst=small)
+            self._preview = small
         except Exception as e:
-            print("Writer error:", e)
+            print(f"Preview error: {e}")
+
+    def preview(self):
+        return self._preview
+
+    def attach(self, sink, since_ts):
+        """Feed `sink` with buffered frames newer than `since_ts`, then every new frame."""
+        with self._lock:
+            backlog = list(self._buf)
+            if self._quality:
+                backlog += list(self._pending)
+            for ts, frame in backlog:
+                if ts >= since_ts:
+                    sink.offer(frame, ts, preroll=True)
+            self._sinks.append(sink)
+
+    def detach(self, sink):
+        with self._lock:
+            if sink in self._sinks:
+                self._sinks.remove(sink)
+        sink.tail_done.set()
+
+    def detach_all(self):
+        with self._lock:
+            sinks, self._sinks = self._sinks, []
+        for sink in sinks:
+            sink.tail_done.set()
+
+    def clear(self):
+        with self._lock:
+            self._buf.clear()
+            if self._quality:
+                self._pending.clear()
 
 # ─────────────────────────────────────────────
-#  VIDEO RECORDING
+#  STREAM-COPY (PASSTHROUGH) RECORDING
 # ─────────────────────────────────────────────
 
-def get_dims(quality):
-    return {'Low': (640, 480), 'Medium': (1280, 720),
-            'High': (1920, 1080), 'Ultra': (3840, 2160)}.get(quality, (1920, 1080))
+class PacketRing(FrameRing):
+    """FrameRing holding the camera's own compressed packets.
+
+    Used in passthrough mode. Attaching rewinds to the last keyframe at or
+    before `since_ts` so every recording starts on a decodable GOP. The
+    preview frame is set separately from a low-rate decode.
+    """
+    def __init__(self, maxlen, stream, preview_fps=10):
+        super().__init__(maxlen, preview_fps=preview_fps)
+        self.stream = stream
+
+    def push(self, packet, ts=None):
+        ts = ts or time.time()
+        with self._lock:
+            self._buf.append((ts, packet))
+            for sink in list(self._sinks):
+                if not sink.offer(packet, ts):
+                    self._sinks.remove(sink)
+                    sink.tail_done.set()
+
+    def attach(self, sink, since_ts):
+        with self._lock:
+            backlog = list(self._buf)
+            start = 0
+            for i, (ts, packet) in enumerate(backlog):
+                if ts > since_ts:
+                    break
+                if packet.is_keyframe:
+                    start = i
+            for ts, packet in backlog[start:]:
+                sink.offer(packet, ts, preroll=True)
+            self._sinks.append(sink)
+
+class PacketMuxer:
+    """Writes camera packets into an MP4 without re-encoding.
+
+    Mirrors the parts of cv2.VideoWriter the writer thread uses. Packets
+    arrive from the shared ring as bytes plus timestamps in the camera
+    stream's time base, and are rebased so the file starts at zero.
+    """
+    def __init__(self, path, template):
+        # faststart: libavformat moves the index to the front on close
+        self._out = av.open(path, "w", format="mp4", options={"movflags": "faststart"})
+        if hasattr(self._out, "add_stream_from_template"):
+            self._stream = self._out.add_stream_from_template(template)
+        else:
+            self._stream = self._out.add_stream(template=template)
+        self._time_base = template.time_base
+        self._base = None
 
-def start_video_recording(b1, _):
-    global current_writer, current_output_file, frame_width, frame_height
-    b1 = b1.replace('\r', '').replace('\n', '')
-    ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    vp = VIDEO_FOLDER
-    os.makedirs(vp, exist_ok=True)
-    current_output_file = f"{vp}/{b1}_{ts}.mp4"
-    fourcc = cv2.VideoWriter_fourcc(*'H264')
-    current_writer = cv2.VideoWriter(
-        current_output_file, fourcc,
-        config.get('frame_rate', 30), (frame_width, frame_height))
-    if not current_writer.isOpened():
-        gui.log("Could not open video writer", "err")
-        current_writer = None
-        return False
+    def isOpened(self):
+        return self._out is not None
+
+    def write_packet(self, data, pts, dts, is_keyframe):
+        if self._base is None:
+            if not is_keyframe:
+                return
+            self._base = dts
+        out = av.Packet(data)
+        out.time_base   = self._time_base
+        out.pts         = pts - self._base
+        out.dts         = dts - self._base
+        out.is_keyframe = is_keyframe
+        out.stream      = self._stream
+        self._out.mux(out)
+
+    def release(self):
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+
+class LiveSegmenter:
+    """Cuts camera packets into short MPEG-TS segments for live viewing.
+
+    Runs beside the PacketMuxer on the same packets, so nothing is
+    re-encoded. A segment is closed at the first keyframe `seconds` after
+    it began and handed to the live uploader with its duration.
+    """
+    def __init__(self, session, template, seconds):
+        self.session    = session
+        self._template  = template
+        self._time_base = template.time_base
+        self._seconds   = seconds
+        self._dir       = os.path.join(VIDEO_FOLDER, "live", uuid.uuid4().hex)
+        os.makedirs(self._dir, exist_ok=True)
+        self._out   = None
+        self._path  = None
+        self._base  = None
+        self._start = None
+        self._last  = None
+        self.seq    = 0
+
+    def write_packet(self, data, pts, dts, is_keyframe):
+        if self._base is None:
+            if not is_keyframe:
+                return
+            self._base = dts
+        if is_keyframe and (self._out is None or
+                            (dts - self._start) * self._time_base >= self._seconds):
+            if self._out is not None:
+                self._finish(dts)
+            self._open(dts)
+        out = av.Packet(data)
+        out.time_base   = self._time_base
+        out.pts         = pts - self._base
+        out.dts         = dts - self._base
+        out.is_keyframe = is_keyframe
+        out.stream      = self._stream
+        self._out.mux(out)
+        self._last = dts
+
+    def _open(self, dts):
+        self._path = os.path.join(self._dir, f"{self.seq}.ts")
+        self._out  = av.open(self._path, "w", format="mpegts")
+        if hasattr(self._out, "add_stream_from_template"):
+            self._stream = self._out.add_stream_from_template(self._template)
+        else:
+            self._stream = self._out.add_stream(template=self._template)
+        self._start = dts
+
+    def _finish(self, end_dts):
+        self._out.close()
+        self._out = None
+        duration = float((end_dts - self._start) * self._time_base)
+        live_uploader.push(self.session, self.seq, self._path, duration)
+        self.seq += 1
+
+    def release(self):
+        if self._out is not None:
+            # The last packet lasts about one frame
+            rate = self._template.average_rate or 25
+            self._finish(self._last + 1 / (rate * self._time_base))
+        live_uploader.push(self.session, None, self._dir, 0)
+
+# ─────────────────────────────────────────────
+#  MP4 FAST START
+# ─────────────────────────────────────────────
+
+MP4_CONTAINERS = {b"moov", b"trak", b"mdia", b"minf", b"stbl"}
+
+def mp4_atoms(f, start, end):
+    """(type, offset, size, header size) of each atom between two offsets"""
+    atoms = []
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        size, kind = struct.unpack(">I4s", f.read(8))
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", f.read(8))[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            raise ValueError(f"bad MP4 atom size at {pos}")
+        atoms.append((kind, pos, size, header))
+        pos += size
+    return atoms
+
+def shift_chunk_offsets(moov, delta):
+    """Add `delta` to every stco/co64 entry in a moov atom, in place"""
+    def walk(start, end):
+        pos = start
+        while pos + 8 <= end:
+            size, kind = struct.unpack_from(">I4s", moov, pos)
+            header = 8
+            if size == 1:
+                size = struct.unpack_from(">Q", moov, pos + 8)[0]
+                header = 16
+            if size < header:
+                raise ValueError("bad MP4 atom size in moov")
+            if kind in MP4_CONTAINERS:
+                walk(pos + header, pos + size)
+            elif kind in (b"stco", b"co64"):
+                count = struct.unpack_from(">I", moov, pos + header + 4)[0]
+                dtype = ">u4" if kind == b"stco" else ">u8"
+                first = pos + header + 8
+                table = np.frombuffer(moov, dtype, count, first).astype(np.uint64) + delta
+                if kind == b"stco" and count and table.max() > 0xFFFFFFFF:
+                    raise ValueError("chunk offsets overflow stco")
+                moov[first:first + table.astype(dtype).nbytes] = table.astype(dtype).tobytes()
+            pos += size
+    walk(8 if struct.unpack_from(">I", moov)[0] != 1 else 16, len(moov))
+
+def faststart_mp4(path):
+    """Move an MP4's moov atom (the index) in front of the media data.
+
+    cv2.VideoWriter writes it last, so a browser has to fetch the end of
+    the file before it can start playing. This does what qt-faststart
+    does: copy the file with moov right after ftyp and chunk offsets
+    moved up by moov's size. Nothing is re-encoded. Returns False when the
+    file is already fast-start (or not something it understands).
+    """
+    total = os.path.getsize(path)
+    with open(path, "rb") as f:
+        atoms = mp4_atoms(f, 0, total)
+        kinds = [a[0] for a in atoms]
+        if b"moov" not in kinds or b"mdat" not in kinds:
+            return False
+        moov_at = kinds.index(b"moov")
+        if moov_at < kinds.index(b"mdat"):
+            return False
+        _, moov_pos, moov_size, _ = atoms[moov_at]
+        f.seek(moov_pos)
+        moov = bytearray(f.read(moov_size))
+        shift_chunk_offsets(moov, moov_size)
+
+        # Everything between ftyp and moov moves down by moov's size
+        order = [a for a in atoms if a[0] != b"moov"]
+        insert_at = 1 if order and order[0][0] == b"ftyp" else 0
+        tmp = path + ".faststart"
+        try:
+            with open(tmp, "wb") as out:
+                for i, (_, pos, size, _) in enumerate(order):
+                    if i == insert_at:
+                        out.write(moov)
+                    f.seek(pos)
+                    left = size
+                    while left:
+                        block = f.read(min(left, UPLOAD_CHUNK_SIZE))
+                        if not block:
+                            raise ValueError("MP4 truncated")
+                        out.write(block)
+                        left -= len(block)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+    # Windows can't replace a file that is still open
+    os.replace(tmp, path)
     return True
 
-def stop_video_recording():
-    global current_writer
-    with writer_lock:
-        if current_writer:
-            current_writer.release()
-            current_writer = None
-            gui.log(f"Video saved: {current_output_file}", "ok")
+# ─────────────────────────────────────────────
+#  SHARED FRAME RING
+# ─────────────────────────────────────────────
+
+SLOT_RAW, SLOT_JPEG, SLOT_PACKET, SLOT_FLUSH, SLOT_OPEN, SLOT_CLOSE, SLOT_STOP = range(7)
+OVERFLOW_POLICIES = ("block", "drop-oldest", "drop-newest")
+
+class SlotItem:
+    __slots__ = ("session", "kind", "data", "pts", "dts", "flags")
+
+    def __init__(self, session, kind, data, pts, dts, flags):
+        self.session = session
+        self.kind    = kind
+        self.data    = data
+        self.pts     = pts
+        self.dts     = dts
+        self.flags   = flags
+
+class SharedFrameRing:
+    """Preallocated ring of frame slots in shared memory.
+
+    Single producer, single consumer. A frame is copied into its slot once
+    and the consumer gets a numpy view straight onto that slot, so the
+    writer can sit in another thread or another process without frames
+    being pickled or copied again. When every slot is taken `policy`
+    decides what happens to a new frame:
+
+      block        wait up to `block_timeout` for a free slot, then drop it
+      drop-oldest  overwrite the oldest unread frame (drops the new frame
+                   instead if the consumer is busy with that slot)
+      drop-newest  drop the new frame
+    """
+    META = 8    # session, kind, length, height, width, pts, dts, flags
+    C_HEAD, C_TAIL, C_CLAIMED, C_ACK, C_PUT, C_GOT, C_DROP_NEW, C_DROP_OLD, C_BLOCKED = range(9)
+    COUNTERS = 16
+
+    def __init__(self, slots, slot_bytes, policy="block", block_timeout=1.0):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.slots = slots
+        self.slot_bytes = -(-slot_bytes // 64) * 64
+        self.policy = policy
+        self.block_timeout = block_timeout
+        size = self.slots * (self.slot_bytes + self.META * 8) + self.COUNTERS * 8
+        self._shm = shared_memory.SharedMemory(create=True, size=size)
+        self._owner = True
+        self._cond = mp.get_context("spawn").Condition()
+        self._map()
+
+    def _map(self):
+        buf = self._shm.buf
+        off = self.slots * self.slot_bytes
+        self._data = np.ndarray((self.slots, self.slot_bytes), np.uint8, buffer=buf)
+        self._meta = np.ndarray((self.slots, self.META), np.int64, buffer=buf, offset=off)
+        self._ctr  = np.ndarray((self.COUNTERS,), np.int64, buffer=buf,
+                                offset=off + self.slots * self.META * 8)
+
+    def __getstate__(self):
+        return {"name": self._shm.name, "slots": self.slots, "slot_bytes": self.slot_bytes,
+                "policy": self.policy, "block_timeout": self.block_timeout,
+                "cond": self._cond}
+
+    def __setstate__(self, st):
+        self.slots = st["slots"]
+        self.slot_bytes = st["slot_bytes"]
+        self.policy = st["policy"]
+        self.block_timeout = st["block_timeout"]
+        self._cond = st["cond"]
+        self._shm = shared_memory.SharedMemory(name=st["name"])
+        self._owner = False
+        self._map()
+
+    # ── Producer ─────────────────────────────
+
+    def _used(self):
+        return self._ctr[self.C_HEAD] - self._ctr[self.C_TAIL]
+
+    def put(self, session, kind, payload=None, shape=(0, 0), pts=0, dts=0, flags=0):
+        """Store one item. Returns (stored, session id of an evicted frame or None)."""
+        ctr = self._ctr
+        n = 0 if payload is None else payload.nbytes
+        evicted = None
+        with self._cond:
+            if n > self.slot_bytes:
+                ctr[self.C_DROP_NEW] += 1
+                return False, None
+            if self._used() >= self.slots:
+                if self.policy == "block":
+                    ctr[self.C_BLOCKED] += 1
+                    if not self._cond.wait_for(lambda: self._used() < self.slots,
+                                               self.block_timeout):
+                        ctr[self.C_DROP_NEW] += 1
+                        return False, None
+                elif (self.policy == "drop-oldest" and not ctr[self.C_CLAIMED]
+                      and self._meta[ctr[self.C_TAIL] % self.slots, 1] < SLOT_FLUSH):
+                    evicted = int(self._meta[ctr[self.C_TAIL] % self.slots, 0])
+                    ctr[self.C_TAIL] += 1
+                    ctr[self.C_DROP_OLD] += 1
+                else:
+                    ctr[self.C_DROP_NEW] += 1
+                    return False, None
+            i = ctr[self.C_HEAD] % self.slots
+        # Slot i only becomes visible to the consumer once HEAD moves past it
+        if n:
+            self._data[i, :n] = payload.reshape(-1)
+        self._meta[i] = (session, kind, n, shape[0], shape[1], pts, dts, flags)
+        with self._cond:
+            ctr[self.C_HEAD] += 1
+            ctr[self.C_PUT]  += 1
+            self._cond.notify_all()
+        return True, evicted
+
+    def wait_ack(self, token, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(lambda: self._ctr[self.C_ACK] >= token, timeout)
+
+    # ── Consumer ─────────────────────────────
+
+    def get(self, timeout=None):
+        """Claim the oldest item; call release() once done with its data."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._used() > 0, timeout):
+                return None
+            i = self._ctr[self.C_TAIL] % self.slots
+            self._ctr[self.C_CLAIMED] = 1
+        session, kind, n, h, w, pts, dts, flags = (int(v) for v in self._meta[i])
+        data = self._data[i, :n]
+        if kind == SLOT_RAW:
+            data = data.reshape(h, w, 3)
+        return SlotItem(session, kind, data, pts, dts, flags)
+
+    def release(self):
+        with self._cond:
+            self._ctr[self.C_TAIL] += 1
+            self._ctr[self.C_GOT]  += 1
+            self._ctr[self.C_CLAIMED] = 0
+            self._cond.notify_all()
+
+    def ack(self, token):
+        with self._cond:
+            self._ctr[self.C_ACK] = max(self._ctr[self.C_ACK], token)
+            self._cond.notify_all()
+
+    # ── Housekeeping ─────────────────────────
+
+    def stats(self):
+        c = self._ctr
+        return {"slots": self.slots, "queued": int(self._used()),
+                "put": int(c[self.C_PUT]), "written": int(c[self.C_GOT]),
+                "dropped_newest": int(c[self.C_DROP_NEW]),
+                "dropped_oldest": int(c[self.C_DROP_OLD]),
+                "blocked": int(c[self.C_BLOCKED])}
+
+    def close(self):
+        self._data = self._meta = self._ctr = None
+        self._shm.close()
+        if self._owner:
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
 
 # ─────────────────────────────────────────────
-#  MAIN VIDEO LOOP
+#  ENCODER PROCESS
 # ─────────────────────────────────────────────
 
-def video_loop():
-    global cap, recording, barcode_value, is_recording, current_packaging_id
-    global frame_width, frame_height, app_running, pre_buffer, preview_frame
+def encoder_worker(ring, status_q):
+    """Owns the cv2.VideoWriters for one camera, in a process of its own.
+
+    Everything arrives through the shared ring in order: open and close
+    requests, frames and flush markers. Frames written and encode latency
+    go back on `status_q` about once a second.
+    """
+    writers = {}
+    written = {}
+    lat_sum, lat_max, lat_n = 0.0, 0.0, 0
+    last_report = time.time()
+    while True:
+        item = ring.get(timeout=1)
+        if item is not None:
+            try:
+                sid = item.session
+                if item.kind == SLOT_STOP:
+                    break
+                if item.kind == SLOT_FLUSH:
+                    ring.ack(item.pts)
+                elif item.kind == SLOT_OPEN:
+                    spec = json.loads(item.data.tobytes())
+                    w = cv2.VideoWriter(spec["path"], cv2.VideoWriter_fourcc(*spec["fourcc"]),
+                                        spec["fps"], tuple(spec["size"]))
+                    if w.isOpened():
+                        writers[sid] = w
+                        written[sid] = 0
+                    status_q.put(("opened", sid, w.isOpened()))
+                elif item.kind == SLOT_CLOSE:
+                    w = writers.pop(sid, None)
+                    if w:
+                        w.release()
+                    status_q.put(("closed", sid, written.pop(sid, 0)))
+                elif sid in writers:
+                    img = item.data
+                    if item.kind == SLOT_JPEG:
+                        # JPEG packet from the compressed pre-roll
+                        img = cv2.imdecode(img, cv2.IMREAD_COLOR)
+                    t0 = time.perf_counter()
+                    writers[sid].write(img)
+                    dt = (time.perf_counter() - t0) * 1000
+                    written[sid] += 1
+                    lat_sum += dt
+                    lat_n   += 1
+                    lat_max  = max(lat_max, dt)
+            except Exception as e:
+                print("Encoder error:", e)
+            finally:
+                ring.release()
+        if time.time() - last_report >= 1:
+            status_q.put(("stats", dict(written),
+                          lat_sum / lat_n if lat_n else 0.0, lat_max))
+            lat_sum, lat_max, lat_n = 0.0, 0.0, 0
+            last_report = time.time()
+    for w in writers.values():
+        w.release()
+
+class RemoteWriter:
+    """Stands in for a cv2.VideoWriter that lives in the encoder process."""
+    def __init__(self, station, session):
+        self.station = station
+        self.session = session
+
+    def isOpened(self):
+        return self.session.opened_ok
+
+    def release(self):
+        self.station.send_control(SLOT_CLOSE, self.session.id)
+        self.session.closed.wait(30)
 
-    try:
-        rtsp = config.get('rtsp_url', '0')
+# ─────────────────────────────────────────────
+#  RECORDING SESSION
+# ─────────────────────────────────────────────
+
+class RecordingSession:
+    """One order, from barcode #1 to the end of its post-buffer.
+
+    Each session owns its writer, so the tail of one order can still be
+    recording and uploading while the next order is already being filmed.
+    """
+    _ids = itertools.count(1)
+
+    def __init__(self, station, b1):
+        self.id = next(self._ids)
+        self.station = station
+        self.b1 = b1
+        self.b2 = None
+        self.local_id     = None
+        self.output_file  = None
+        self.writer       = None
+        self.until_ts     = None   # end of the post-buffer, set on barcode #2
+        self.frames       = 0
+        self.written      = 0
+        self.dropped      = 0
+        self.tail_done    = threading.Event()
+        self.opened       = threading.Event()
+        self.opened_ok    = False
+        self.closed       = threading.Event()
+        self.live         = None   # LiveSegmenter in passthrough mode
+        self.live_failed  = False  # the server refused this record's live segments
+
+    def offer(self, frame, ts, preroll=False):
+        """Queue one frame for the writer.
+
+        Pre-roll frames are already held by the frame ring, so they are
+        never capped here. Live frames are: only WRITER_OUTBOX_FRAMES may
+        wait for the feeder, which leaves buffering (and the overflow
+        policy) to the shared ring.
+        """
+        if self.until_ts is not None and ts > self.until_ts:
+            return False
+        st = self.station
+        if not preroll and st.outbox_in - st.outbox_out >= WRITER_OUTBOX_FRAMES:
+            self.dropped += 1
+            return True
+        if not preroll:
+            st.outbox_in += 1
+        st.outbox.append((self, frame, not preroll))
+        st.outbox_event.set()
+        self.frames += 1
+        return True
+
+# ─────────────────────────────────────────────
+#  CAMERA STATION
+# ─────────────────────────────────────────────
+
+def get_dims(quality):
+    return {'Low': (640, 480), 'Medium': (1280, 720),
+            'High': (1920, 1080), 'Ultra': (3840, 2160)}.get(quality, (1920, 1080))
+
+def camera_configs():
+    """One dict per packing table; a plain config describes a single camera."""
+    cams = config.get('cameras') or [{}]
+    out = []
+    for i, cam in enumerate(cams):
+        cfg = dict(config)
+        cfg.pop('cameras', None)
+        cfg.update(cam)
+        cfg.setdefault('name', config.get('workstation_name') if len(cams) == 1
+                       else f"CAM {i + 1}")
+        out.append(cfg)
+    return out
+
+class CameraStation:
+    """Everything one camera needs: capture, frame ring, writer and barcode state.
+
+    Each station runs its own capture, controller and writer threads, so
+    several packing tables can share one PC without sharing a bottleneck.
+    """
+    def __init__(self, index, cfg):
+        self.index = index
+        self.cfg   = cfg
+        self.name  = cfg['name']
+        self.cap   = None
+        self.frame_ring   = None
+        self.frame_width  = 640
+        self.frame_height = 480
+        self.passthrough  = False
+        self.is_recording = False
+        self.current_session = None
+        self.barcode_queue = Queue()
+        # Frames bound for the writer: the capture thread only appends
+        # references here, the feeder copies them into the shared ring.
+        # outbox_in is bumped by the capture thread and outbox_out by the
+        # feeder, so each counter has a single writer.
+        self.outbox        = deque()
+        self.outbox_event  = threading.Event()
+        self.outbox_in     = 0
+        self.outbox_out    = 0
+        self.frame_slots   = None
+        self.encoder       = None
+        self.status_q      = None
+        self.encode_latency = (0.0, 0.0)
+        self._preroll_dropped = 0
+        self.sessions_by_id = {}
+        self.writer_lock   = threading.Lock()
+        self._flush_tokens = itertools.count(1)
+        self.running = True
+        self._closed = False
+        self.threads = []
+
+    def log(self, msg, tag="ok"):
+        gui.log(msg if len(stations) == 1 else f"[{self.name}] {msg}", tag)
+
+    def is_active(self):
+        """The session panel follows whichever station was scanned last."""
+        return gui.active_station is self
+
+    def start(self):
+        self._spawn(self.video_loop)
+
+    def _spawn(self, target):
+        t = threading.Thread(target=target, daemon=True)
+        t.start()
+        self.threads.append(t)
+
+    # ── Writer ───────────────────────────────
+
+    def open_frame_slots(self):
+        slots  = self.cfg.get('writer_buffer_frames') or self.cfg.get('frame_rate', 30)
+        policy = self.cfg.get('writer_overflow', 'block')
+        if policy not in OVERFLOW_POLICIES:
+            self.log(f"Unknown writer_overflow '{policy}' — using block", "warn")
+            policy = "block"
+        slot_bytes = self.frame_width * self.frame_height * 3
+        if self.passthrough:
+            # Slots only carry compressed packets; even keyframes stay far
+            # below a raw frame, and an oversized one is dropped and counted.
+            slot_bytes //= PACKET_SLOT_DIVISOR
+        self.frame_slots = SharedFrameRing(slots, slot_bytes, policy)
+
+    def start_encoder(self):
+        ctx = mp.get_context("spawn")
+        status_q = ctx.Queue()
+        proc = ctx.Process(target=encoder_worker, args=(self.frame_slots, status_q),
+                           name=f"encoder-{self.index + 1}", daemon=True)
+        try:
+            proc.start()
+        except Exception as e:
+            self.log(f"Encoder process failed ({e}) — encoding in-process", "warn")
+            self._spawn(self.frame_writer_thread)
+            return
+        self.status_q, self.encoder = status_q, proc
+        self._spawn(self.encoder_status_thread)
+
+    def encoder_status_thread(self):
+        """Apply progress reports from the encoder process."""
+        while self.running:
+            try:
+                msg = self.status_q.get(timeout=1)
+            except Empty:
+                continue
+            except (EOFError, OSError):
+                break
+            kind, sid = msg[0], msg[1]
+            if kind == "stats":
+                for s, n in sid.items():
+                    session = self.sessions_by_id.get(s)
+                    if session:
+                        session.written = n
+                self.encode_latency = (msg[2], msg[3])
+                if self.is_active() and self.current_session:
+                    gui.update_current_info(
+                        encode=f"{msg[2]:.1f} ms avg · {msg[3]:.0f} max · "
+                               f"{self.current_session.written} fr")
+                continue
+            session = self.sessions_by_id.get(sid)
+            if session is None:
+                continue
+            if kind == "opened":
+                session.opened_ok = msg[2]
+                session.opened.set()
+            elif kind == "closed":
+                session.written = msg[2]
+                session.closed.set()
+
+    def send_control(self, kind, session_id=0, payload=None):
+        self.outbox.append((None, (kind, session_id, payload), False))
+        self.outbox_event.set()
+
+    def frame_feeder_thread(self):
+        """Copy queued frames into the shared ring, applying its overflow policy."""
+        ring = self.frame_slots
+        while self.running:
+            if not self.outbox:
+                self.outbox_event.wait(1)
+                self.outbox_event.clear()
+                continue
+            session, item, live = self.outbox.popleft()
+            if live:
+                self.outbox_out += 1
+            try:
+                if session is None:
+                    # Control messages always wait for a slot, whatever the policy
+                    kind, sid, payload = item
+                    while not ring.put(sid, kind, payload,
+                                       pts=sid if kind == SLOT_FLUSH else 0)[0] \
+                            and self.running:
+                        time.sleep(0.01)
+                    continue
+                if isinstance(item, np.ndarray):
+                    if item.ndim == 3:
+                        stored, evicted = ring.put(session.id, SLOT_RAW, item, item.shape[:2])
+                    else:
+                        stored, evicted = ring.put(session.id, SLOT_JPEG, item)
+                else:
+                    dts = item.dts if item.dts is not None else item.pts
+                    stored, evicted = ring.put(
+                        session.id, SLOT_PACKET, np.frombuffer(bytes(item), np.uint8),
+                        pts=item.pts if item.pts is not None else dts, dts=dts,
+                        flags=int(item.is_keyframe))
+                self._count_drops(session, stored, evicted)
+            except Exception as e:
+                print("Feeder error:", e)
+
+    def _count_drops(self, session, stored, evicted):
+        if not stored:
+            session.dropped += 1
+        if evicted:
+            victim = self.sessions_by_id.get(evicted)
+            if victim:
+                victim.dropped += 1
+
+    def frame_writer_thread(self):
+        ring = self.frame_slots
+        while self.running:
+            item = ring.get(timeout=1)
+            if item is None:
+                continue
+            try:
+                if item.kind == SLOT_FLUSH:
+                    ring.ack(item.pts)
+                    continue
+                session = self.sessions_by_id.get(item.session)
+                if session is None:
+                    continue
+                img = item.data
+                if item.kind == SLOT_JPEG:
+                    # JPEG packet from the compressed pre-roll
+                    img = cv2.imdecode(img, cv2.IMREAD_COLOR)
+                with self.writer_lock:
+                    if not session.writer:
+                        continue
+                    if item.kind == SLOT_PACKET:
+                        session.writer.write_packet(item.data.tobytes(), item.pts,
+                                                    item.dts, bool(item.flags))
+                        if session.live:
+                            try:
+                                session.live.write_packet(item.data.tobytes(), item.pts,
+                                                          item.dts, bool(item.flags))
+                            except Exception as e:
+                                # Live view is extra; the recording carries on
+                                print("Live segment error:", e)
+                                session.live = None
+                    else:
+                        session.writer.write(img)
+            except Exception as e:
+                print("Writer error:", e)
+            finally:
+                ring.release()
+
+    def flush_frame_queue(self, timeout=30):
+        """Block until the writer has consumed everything queued so far."""
+        token = next(self._flush_tokens)
+        self.send_control(SLOT_FLUSH, token)
+        return self.frame_slots.wait_ack(token, timeout)
+
+    def start_video_recording(self, session):
+        b1 = session.b1.replace('\r', '').replace('\n', '')
+        ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        vp = VIDEO_FOLDER
+        os.makedirs(vp, exist_ok=True)
+        tag = f"cam{self.index + 1}_" if len(stations) > 1 else ""
+        session.output_file = f"{vp}/{tag}{b1}_{ts}.mp4"
+        self.sessions_by_id[session.id] = session
+        try:
+            if self.encoder:
+                spec = {"path": os.path.abspath(session.output_file), "fourcc": VIDEO_FOURCC,
+                        "fps": self.cfg.get('frame_rate', 30),
+                        "size": [self.frame_width, self.frame_height]}
+                self.send_control(SLOT_OPEN, session.id,
+                                  np.frombuffer(json.dumps(spec).encode(), np.uint8))
+                session.opened.wait(10)
+                session.writer = RemoteWriter(self, session)
+            elif self.passthrough:
+                session.writer = PacketMuxer(session.output_file, self.frame_ring.stream)
+                if self.cfg.get('live_segment_seconds', 0):
+                    session.live = LiveSegmenter(session, self.frame_ring.stream,
+                                                 self.cfg['live_segment_seconds'])
+            else:
+                fourcc = cv2.VideoWriter_fourcc(*VIDEO_FOURCC)
+                session.writer = cv2.VideoWriter(
+                    session.output_file, fourcc,
+                    self.cfg.get('frame_rate', 30), (self.frame_width, self.frame_height))
+        except Exception as e:
+            self.log(f"Video writer error: {e}", "err")
+            session.writer = None
+            self.sessions_by_id.pop(session.id, None)
+            return False
+        if not session.writer.isOpened():
+            self.log("Could not open video writer", "err")
+            session.writer = None
+            self.sessions_by_id.pop(session.id, None)
+            return False
+        with sessions_lock:
+            open_sessions.add(session)
+        return True
+
+    def stop_video_recording(self, session):
+        if self.running:
+            self.flush_frame_queue()
+        with self.writer_lock:
+            if session.writer:
+                session.writer.release()
+                session.writer = None
+                self.log(f"Video saved: {session.output_file}", "ok")
+            if session.live:
+                session.live.release()
+                session.live = None
+        self.sessions_by_id.pop(session.id, None)
+        with sessions_lock:
+            open_sessions.discard(session)
+
+    def discard_video_recording(self, session):
+        self.stop_video_recording(session)
+        if session.output_file:
+            try:
+                os.remove(session.output_file)
+            except:
+                pass
+
+    # ── Capture ──────────────────────────────
+
+    def open_camera(self):
+        cfg = self.cfg
+        self.passthrough = cfg.get('recording_mode', 'encode') == 'passthrough'
+        if self.passthrough and av is None:
+            self.log("Passthrough needs PyAV (pip install av) — re-encoding instead", "warn")
+            self.passthrough = False
+        if self.passthrough:
+            return self.open_camera_passthrough()
+        rtsp = cfg.get('rtsp_url', '0')
         if str(rtsp).isdigit():
             rtsp = int(rtsp)
-        cap = cv2.VideoCapture(rtsp)
+        cap = self.cap = cv2.VideoCapture(rtsp)
         if not cap.isOpened():
-            gui.log("Could not open video stream", "err")
-            return
-        frame_width, frame_height = get_dims(config.get('video_quality', 'High'))
-        cap.set(cv2.CAP_PROP_FRAME_WIDTH, frame_width)
-        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, frame_height)
-        frame_width  = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))  or frame_width
-        frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) or frame_height
+            return False
+        fw, fh = get_dims(cfg.get('video_quality', 'High'))
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, fw)
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, fh)
+        self.frame_width  = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))  or fw
+        self.frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) or fh
         cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
-        pre_buffer = deque(maxlen=config.get('pre_buffer_duration', 5)
-                           * config.get('frame_rate', 30))
-        gui.log(f"Camera started — {frame_width}×{frame_height}", "ok")
-        gui.update_status("Waiting for first barcode…", "idle")
-        b1 = None
-        frames_written = 0
-
-        while recording and app_running:
-            ret, frame = cap.read()
-            if not ret:
-                time.sleep(0.01)
+        # One extra second covers the gap between a scan and the controller acting on it
+        quality = PRE_BUFFER_JPEG_QUALITY \
+            if cfg.get('pre_buffer_encoding', 'jpeg') == 'jpeg' else None
+        self.frame_ring = FrameRing((cfg.get('pre_buffer_duration', 5) + 1)
+                                    * cfg.get('frame_rate', 30), jpeg_quality=quality,
+                                    preview_fps=cfg.get('preview_fps', 10))
+        return True
+
+    def open_camera_passthrough(self):
+        cfg = self.cfg
+        try:
+            self.cap = av.open(str(cfg.get('rtsp_url', '')),
+                               options={"rtsp_transport": "tcp"}, timeout=10)
+            stream = self.cap.streams.video[0]
+        except Exception as e:
+            self.log(f"Passthrough open error: {e}", "err")
+            return False
+        if stream.codec_context.name != "h264":
+            self.log(f"Camera sends {stream.codec_context.name}, not H.264", "warn")
+        # Only keyframes are ever decoded, and only to feed the preview
+        stream.codec_context.skip_frame = "NONKEY"
+        self.frame_width  = stream.codec_context.width
+        self.frame_height = stream.codec_context.height
+        # Two extra seconds so the keyframe opening the pre-roll GOP is still held
+        self.frame_ring = PacketRing((cfg.get('pre_buffer_duration', 5) + 3)
+                                     * cfg.get('frame_rate', 30), stream,
+                                     preview_fps=cfg.get('preview_fps', 10))
+        return True
+
+    def capture_loop(self):
+        """Grab frames at camera rate; never touches the network or the writer."""
+        cap, ring = self.cap, self.frame_ring
+        size = (self.frame_width, self.frame_height)
+        try:
+            while recording and app_running:
+                ret, frame = cap.read()
+                if not ret:
+                    time.sleep(0.01)
+                    continue
+                ts = time.time()
+                if frame.shape[1] != size[0] or frame.shape[0] != size[1]:
+                    frame = cv2.resize(frame, size)
+                ring.push(frame, ts)
+        except Exception as e:
+            self.log(f"Capture error: {e}", "err")
+        finally:
+            if cap.isOpened():
+                cap.release()
+
+    def capture_loop_passthrough(self):
+        """Demux camera packets into the ring; decode only what the preview needs."""
+        ring = self.frame_ring
+        stream = ring.stream
+        sidestream = bool(self.cfg.get('preview_url'))
+        try:
+            for packet in self.cap.demux(stream):
+                if not (recording and app_running):
+                    break
+                if packet.dts is None and packet.pts is None:
+                    continue
+                ts = time.time()
+                if packet.is_keyframe and not sidestream:
+                    # Decode before the packet is shared with any writer
+                    try:
+                        for f in packet.decode():
+                            ring.set_preview(f.to_ndarray(format="bgr24"))
+                    except Exception as e:
+                        print(f"Preview decode error: {e}")
+                ring.push(packet, ts)
+        except Exception as e:
+            self.log(f"Capture error: {e}", "err")
+        finally:
+            try:
+                self.cap.close()
+            except:
+                pass
+
+    def preview_sidestream_loop(self):
+        """Feed the preview from the camera's low-resolution substream."""
+        url = self.cfg.get('preview_url')
+        sc = cv2.VideoCapture(int(url) if str(url).isdigit() else url)
+        try:
+            while recording and app_running and sc.isOpened():
+                ret, frame = sc.read()
+                if not ret:
+                    time.sleep(0.05)
+                    continue
+                self.frame_ring.set_preview(frame)
+        finally:
+            sc.release()
+
+    # ── Controller ───────────────────────────
+
+    def video_loop(self):
+        """Controller: reacts to barcodes and talks to the server while capture runs."""
+        try:
+            if not self.open_camera():
+                self.log("Could not open video stream", "err")
+                return
+            self.open_frame_slots()
+            if not self.passthrough and self.cfg.get('encoder_process', True):
+                self.start_encoder()
+            else:
+                self._spawn(self.frame_writer_thread)
+            self._spawn(self.frame_feeder_thread)
+            self._spawn(self.capture_loop_passthrough if self.passthrough
+                        else self.capture_loop)
+            if self.passthrough and self.cfg.get('preview_url'):
+                self._spawn(self.preview_sidestream_loop)
+            self.log(f"Camera started — {self.frame_width}×{self.frame_height}", "ok")
+            if self.index == 0:
+                gui.update_status("Waiting for first barcode…", "idle")
+
+            while recording and app_running:
+                try:
+                    bc = self.barcode_queue.get(timeout=1)
+                except Empty:
+                    if self.is_recording and self.is_active():
+                        gui.update_current_info(frames=self.current_session.frames)
+                    continue
+
+                if not self.is_recording:
+                    self.start_session(bc)
+                else:
+                    self.stop_session(bc)
+
+        except Exception as e:
+            self.log(f"Fatal error: {e}", "err")
+        finally:
+            self.close()
+
+    def start_session(self, bc):
+        scan_ts = time.time()
+        if not bc.strip():
+            # e.g. a scan of nothing but the station's scan_prefix
+            self.log("Empty order barcode ignored", "warn")
+            return
+        session = RecordingSession(self, bc)
+        gui.update_status("⏺  Recording…", "recording")
+        self.log(f"START — Order ID: {session.b1}", "ok")
+        if not self.start_video_recording(session):
+            gui.update_status("Could not open video writer", "error")
+            return
+        # Recording starts before the server round-trip so that a slow
+        # create call never leaves a hole in the footage.
+        self.frame_ring.attach(session,
+                               scan_ts - self.cfg.get('pre_buffer_duration', 5))
+        dropped = self.frame_ring.dropped
+        if dropped > self._preroll_dropped:
+            self.log(f"{dropped - self._preroll_dropped} pre-roll frames dropped — "
+                     "JPEG encoder can't keep up; consider \"pre_buffer_encoding\": \"raw\"",
+                     "warn")
+            self._preroll_dropped = dropped
+        self.current_session = session
+        self.is_recording = True
+        # Journaled locally; the sync worker creates the server record later
+        session.local_id = packaging_journal.create(session.b1, self.cfg.get('ws_id'))
+        gui.add_task({'id': session.local_id, 'barcode1': session.b1,
+                      'status': 'Recording',
+                      'time': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
+        if self.is_active():
+            gui.update_current_info(packaging_id=session.local_id,
+                                    barcode1=session.b1, barcode2="—",
+                                    frames=session.frames)
+
+    def stop_session(self, bc):
+        session = self.current_session
+        session.b2 = bc
+        session.until_ts = time.time() + self.cfg.get('post_buffer_duration', 5)
+        self.is_recording = False
+        self.current_session = None
+        self.log(f"STOP — Barcode 2: {session.b2}", "ok")
+        finalize_queue.put(session)
+        if self.is_active():
+            gui.update_current_info(
+                packaging_id="—", barcode1="—", barcode2="—", frames=0)
+        gui.update_status("Ready — waiting for barcode…",
+                          "recording" if any_recording() else "idle")
+        self.log("Ready for next recording", "info")
+        gui.scan_sub.configure(text="scan #1 → starts recording",
+                               fg=C["text3"])
+
+    def close(self):
+        with sessions_lock:
+            if self._closed:
+                return
+            self._closed = True
+        self.is_recording = False
+        if self.frame_ring:
+            self.frame_ring.detach_all()
+        with sessions_lock:
+            sessions = [s for s in open_sessions if s.station is self]
+        for session in sessions:
+            self.stop_video_recording(session)
+        if self.encoder:
+            self.send_control(SLOT_STOP)
+            self.encoder.join(timeout=5)
+            if self.encoder.is_alive():
+                self.encoder.terminate()
+        self.running = False
+        self.outbox_event.set()
+        for t in self.threads:
+            if t is not threading.current_thread() and t.is_alive():
+                t.join(timeout=2)
+        if self.frame_slots:
+            stats = self.frame_slots.stats()
+            if stats["dropped_newest"] or stats["dropped_oldest"]:
+                print(f"[{self.name}] writer ring: {stats}")
+            self.frame_slots.close()
+
+def any_recording():
+    return any(st.is_recording for st in stations)
+
+def route_barcode(code):
+    """Pick the station a scan belongs to.
+
+    Keyboard-wedge scanners all type into the same field, so stations are
+    told apart by a per-camera `scan_prefix` programmed into each scanner.
+    Codes without a known prefix go to the first camera.
+    """
+    for st in stations:
+        prefix = st.cfg.get('scan_prefix')
+        if prefix and code.startswith(prefix):
+            return st, code[len(prefix):]
+    return stations[0], code
+
+# ─────────────────────────────────────────────
+#  SESSION FINALIZER
+# ─────────────────────────────────────────────
+
+def finalize_session(session):
+    """Runs after barcode #2: let the tail record, then close, rename and upload."""
+    st = session.station
+    packaging_journal.close_record(session.local_id, session.b2)
+    gui.add_task({'id': session.local_id, 'barcode2': session.b2, 'status': 'Uploading',
+                  'time': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
+    # Tail frames keep arriving through the ring until `until_ts`; allow a
+    # little slack in case the camera stalls and no later frame shows up.
+    wait = session.until_ts - time.time() + 2
+    if not session.tail_done.wait(max(wait, 0)):
+        st.frame_ring.detach(session)
+    if session.dropped:
+        st.log(f"{session.dropped} frames dropped — writer fell behind", "warn")
+    st.stop_video_recording(session)
+    if not session.output_file:
+        return
+    try:
+        if faststart_mp4(session.output_file):
+            st.log("Video index moved to the front for instant playback", "info")
+    except Exception as e:
+        st.log(f"Fast-start skipped: {e}", "warn")
+    old = session.output_file
+    ts  = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    tag = f"cam{st.index + 1}_" if len(stations) > 1 else ""
+    new = f"{VIDEO_FOLDER}/{tag}{session.b1}_to_{session.b2}_{ts}.mp4"
+    try:
+        os.rename(old, new)
+        fp = new
+    except:
+        fp = old
+    upload_queue.enqueue(session.local_id, fp)
+
+def session_finalizer_thread():
+    while app_running:
+        try:
+            session = finalize_queue.get(timeout=1)
+        except Empty:
+            continue
+        try:
+            finalize_session(session)
+        except Exception as e:
+            gui.log(f"Finalize error: {e}", "err")
+
+# ─────────────────────────────────────────────
+#  PACKAGING JOURNAL
+# ─────────────────────────────────────────────
+
+class PackagingJournal:
+    """Local SQLite record of every packaging, written before the server hears of it.
+
+    A scan gets a local id at once and recording starts straight away. The
+    sync worker creates and updates the server records afterwards, oldest
+    first, whenever the server is reachable, so a slow or offline server
+    never holds up a station. A row keeps its local id for good and gains
+    `server_id` once the server has created it. A row the server rejects
+    keeps the reason in `sync_error` and is left out of later syncs.
+    """
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS packaging (
+                    local_id TEXT PRIMARY KEY,
+                    ws_id INTEGER,
+                    bar_code_1 TEXT,
+                    start_time TEXT,
+                    bar_code_2 TEXT,
+                    end_time TEXT,
+                    server_id INTEGER,
+                    update_synced INTEGER DEFAULT 0,
+                    sync_error TEXT,
+                    doa DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            try:
+                # Journals created before sync_error existed
+                self._conn.execute("ALTER TABLE packaging ADD COLUMN sync_error TEXT")
+            except sqlite3.OperationalError:
+                pass
+
+    def _execute(self, sql, params=()):
+        with self._lock, self._conn:
+            return self._conn.execute(sql, params).fetchall()
+
+    def create(self, barcode1, ws_id=None):
+        local_id = uuid.uuid4().hex[:10]
+        self._execute("""
+            INSERT INTO packaging (local_id, ws_id, bar_code_1, start_time)
+            VALUES (?, ?, ?, ?)
+        """, (local_id, ws_id or config.get('ws_id'), barcode1,
+              datetime.datetime.now().isoformat()))
+        self._wake.set()
+        return local_id
+
+    def close_record(self, local_id, barcode2):
+        self._execute("""
+            UPDATE packaging SET bar_code_2 = ?, end_time = ?, update_synced = 0
+            WHERE local_id = ?
+        """, (barcode2, datetime.datetime.now().isoformat(), local_id))
+        self._wake.set()
+
+    def server_id(self, local_id):
+        rows = self._execute("SELECT server_id FROM packaging WHERE local_id = ?",
+                             (local_id,))
+        return rows[0]['server_id'] if rows else None
+
+    def sync_error(self, local_id):
+        rows = self._execute("SELECT sync_error FROM packaging WHERE local_id = ?",
+                             (local_id,))
+        return rows[0]['sync_error'] if rows else None
+
+    def pending(self):
+        return self._execute("""
+            SELECT COUNT(*) FROM packaging
+            WHERE sync_error IS NULL
+              AND (server_id IS NULL OR (bar_code_2 IS NOT NULL AND update_synced = 0))
+        """)[0][0]
+
+    def _reject(self, row, message):
+        self._execute("UPDATE packaging SET sync_error = ? WHERE local_id = ?",
+                      (message or "rejected", row['local_id']))
+        gui.log(f"Server rejected {row['bar_code_1'] or '(empty)'} "
+                f"[{row['local_id']}]: {message} — kept locally", "err")
+        gui.add_task({'id': row['local_id'], 'status': 'Failed',
+                      'time': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
+
+    def sync_once(self):
+        """Push unsynced rows to the server in batches. Returns False on failure."""
+        while True:
+            rows = self._execute("""
+                SELECT * FROM packaging
+                WHERE sync_error IS NULL
+                  AND (server_id IS NULL OR (bar_code_2 IS NOT NULL AND update_synced = 0))
+                ORDER BY start_time LIMIT ?
+            """, (SYNC_BATCH_SIZE,))
+            if not rows:
+                return True
+            # Keys are derived from the row, so a batch resent after a lost
+            # reply is recognised by the server instead of applied twice
+            events, by_key = [], {}
+            for row in rows:
+                if row['server_id'] is None:
+                    key = f"{row['local_id']}:create"
+                    events.append({"key": key, "op": "create", "ws_id": row['ws_id'],
+                                   "bar_code_1": row['bar_code_1'],
+                                   "start_time": row['start_time'],
+                                   "bar_code_2": row['bar_code_2'],
+                                   "end_time": row['end_time']})
+                else:
+                    key = f"{row['local_id']}:update:{row['end_time']}"
+                    events.append({"key": key, "op": "update",
+                                   "packaging_id": row['server_id'],
+                                   "bar_code_2": row['bar_code_2'],
+                                   "end_time": row['end_time']})
+                by_key[key] = row
+            results = packaging_batch_api(events)
+            if results is None:
+                return False
+            for r in results:
+                row = by_key.get(r.get('key'))
+                if row is None:
+                    continue
+                if r['status'] == 'error':
+                    # Resending won't change the answer; park the row for the operator
+                    self._reject(row, r.get('message'))
+                    continue
+                if row['server_id'] is None:
+                    # A row closed before it was created went up complete,
+                    # unless it was closed while the batch was in flight
+                    self._execute("""
+                        UPDATE packaging SET server_id = ?, update_synced = (? AND end_time IS ?)
+                        WHERE local_id = ?
+                    """, (r['packaging_id'], int(row['bar_code_2'] is not None),
+                          row['end_time'], row['local_id']))
+                else:
+                    self._execute("""
+                        UPDATE packaging SET update_synced = 1
+                        WHERE local_id = ? AND end_time IS ?
+                    """, (row['local_id'], row['end_time']))
+            gui.log(f"Synced {len(results)} packaging event{'s' if len(results) != 1 else ''}", "ok")
+            if len(rows) < SYNC_BATCH_SIZE:
+                return True
+
+    def worker(self):
+        was_offline = False
+        while app_running:
+            self._wake.wait(5)
+            self._wake.clear()
+            if not api.available():
                 continue
-            if frame.shape[1] != frame_width or frame.shape[0] != frame_height:
-                frame = cv2.resize(frame, (frame_width, frame_height))
+            ok = self.sync_once()
+            if not ok and not was_offline:
+                gui.log(f"Server unavailable — {self.pending()} record(s) kept locally", "warn")
+            elif ok and was_offline:
+                gui.log("Server reachable — local records synced", "ok")
+            was_offline = not ok
+
+def start_packaging_sync():
+    global packaging_journal
+    packaging_journal = PackagingJournal(PACKAGING_DB)
+    threading.Thread(target=packaging_journal.worker, daemon=True).start()
+
+# ─────────────────────────────────────────────
+#  UPLOAD QUEUE
+# ─────────────────────────────────────────────
 
-            # Share frame for preview (throttled — every Nth frame)
-            with preview_lock:
-                preview_frame = frame.copy()
+class UploadQueue:
+    """Recordings waiting to reach the server, journaled to disk.
+
+    Every change rewrites the JSON journal, so footage queued before a
+    crash or restart is picked up again on the next start. Each entry
+    keeps its upload_id for life; the server stores partial uploads under
+    it and reports how many bytes it has, so a retry sends only the rest.
+    Failed attempts back off exponentially, and "upload_kbps" caps the
+    combined rate of all workers.
+    """
+    def __init__(self, path):
+        self.path     = path
+        self._lock    = threading.Lock()
+        self._wake    = threading.Event()
+        self._busy    = set()
+        self._free_at = 0.0
+        self._entries = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except:
+            return []
 
-            if not is_recording:
-                pre_buffer.append(frame)
+    def _save(self):
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self._entries, f, indent=4)
+            os.replace(tmp, self.path)
+        except Exception as e:
+            print(f"Error saving upload queue: {e}")
+
+    def enqueue(self, local_id, path):
+        entry = {"upload_id": uuid.uuid4().hex, "local_id": local_id,
+                 "path": os.path.abspath(path), "attempts": 0, "next_try": 0}
+        with self._lock:
+            self._entries.append(entry)
+            self._save()
+        self._wake.set()
+        gui.add_task({'id': local_id, 'status': 'Queued',
+                      'time': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
 
-            if is_recording:
+    def pending(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _take(self):
+        now = time.time()
+        with self._lock:
+            for entry in self._entries:
+                if entry["upload_id"] not in self._busy and entry["next_try"] <= now:
+                    self._busy.add(entry["upload_id"])
+                    return entry
+        return None
+
+    def _defer(self, entry, seconds):
+        with self._lock:
+            self._busy.discard(entry["upload_id"])
+            entry["next_try"] = time.time() + seconds
+
+    def _finish(self, entry, ok):
+        with self._lock:
+            self._busy.discard(entry["upload_id"])
+            if ok:
+                self._entries.remove(entry)
+            else:
+                entry["attempts"] += 1
+                entry["next_try"] = time.time() + min(2 ** entry["attempts"],
+                                                      UPLOAD_RETRY_MAX)
+            self._save()
+
+    def throttle(self, nbytes):
+        kbps = config.get('upload_kbps', 0)
+        if not kbps:
+            return
+        with self._lock:
+            now = time.time()
+            start = max(self._free_at, now)
+            self._free_at = start + nbytes / (kbps * 1024)
+        if start > now:
+            time.sleep(start - now)
+
+    def sweep(self):
+        """Move aside videos that will never upload and free stale live segments.
+
+        Recordings that never reached the server are not deleted. Once older
+        than "local_retention_days" (0 = never), the recordings of records
+        the server rejected and videos in VIDEO_FOLDER that aren't queued at
+        all (left by a crash between recording and queueing) are moved to
+        QUARANTINE_FOLDER for the operator. Live segments a crash left
+        unsent are only copies of a recording and are deleted. Returns the
+        bytes freed.
+        """
+        days = config.get('local_retention_days', 0)
+        if not days:
+            return 0
+        cutoff = time.time() - days * 86400
+
+        def stale(path):
+            try:
+                return os.path.getmtime(path) < cutoff
+            except OSError:
+                return False
+
+        def quarantine(path, prefix=""):
+            try:
+                os.makedirs(QUARANTINE_FOLDER, exist_ok=True)
+                os.replace(path, os.path.join(QUARANTINE_FOLDER,
+                                              prefix + os.path.basename(path)))
+                gui.log(f"Moved unsent video to {QUARANTINE_FOLDER}: "
+                        f"{os.path.basename(path)}", "warn")
+            except OSError as e:
+                print(f"Error quarantining {path}: {e}")
+
+        def remove(path):
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                return size
+            except OSError:
+                return 0
+
+        with self._lock:
+            entries = list(self._entries)
+        for entry in entries:
+            if entry.get("packaging_id") or packaging_journal.server_id(entry["local_id"]):
+                continue
+            if not packaging_journal.sync_error(entry["local_id"]) or not stale(entry["path"]):
+                continue
+            with self._lock:
+                if entry["upload_id"] in self._busy or entry not in self._entries:
+                    continue
+                self._entries.remove(entry)
+                self._save()
+            # The local id ties the file back to its row in the journal
+            quarantine(entry["path"], f"{entry['local_id']}_")
+
+        with self._lock:
+            queued = {entry["path"] for entry in self._entries}
+        names = os.listdir(VIDEO_FOLDER) if os.path.isdir(VIDEO_FOLDER) else []
+        for name in names:
+            path = os.path.abspath(os.path.join(VIDEO_FOLDER, name))
+            if name.endswith('.mp4') and path not in queued and stale(path):
+                quarantine(path)
+
+        freed = 0
+        for dirpath, _, names in os.walk(os.path.join(VIDEO_FOLDER, "live"), topdown=False):
+            for name in names:
+                path = os.path.join(dirpath, name)
+                if stale(path):
+                    freed += remove(path)
+            if (dirpath != os.path.join(VIDEO_FOLDER, "live") and stale(dirpath)
+                    and not os.listdir(dirpath)):
+                os.rmdir(dirpath)
+
+        if freed:
+            gui.log(f"Freed {freed / (1024 * 1024):.1f} MB of stale live segments", "info")
+        return freed
+
+    def janitor(self):
+        while app_running:
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Error sweeping local videos: {e}")
+            time.sleep(LOCAL_SWEEP_INTERVAL)
+
+    def worker(self):
+        while app_running:
+            entry = self._take()
+            if entry is None:
+                self._wake.wait(1)
+                self._wake.clear()
+                continue
+            if not os.path.exists(entry["path"]):
+                gui.log(f"Queued video missing: {entry['path']}", "err")
+                self._finish(entry, True)
+                continue
+            packaging_id = entry.get("packaging_id") or \
+                packaging_journal.server_id(entry["local_id"])
+            if not packaging_id:
+                # The server record doesn't exist yet; the sync worker is on it.
+                # A rejected record never will; sweep() moves its video aside in time.
+                rejected = packaging_journal.sync_error(entry["local_id"])
+                self._defer(entry, UPLOAD_RETRY_MAX if rejected else 5)
+                continue
+            try:
+                ok = upload_video_api(packaging_id, entry["path"],
+                                      entry["upload_id"], self.throttle)
+            except Exception as e:
+                gui.log(f"Upload error: {e}", "err")
+                ok = False
+            if not ok and not app_running:
+                break
+            if ok:
+                gui.add_task({'id': entry.get("local_id", packaging_id), 'status': 'Completed',
+                              'time': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
                 try:
-                    frame_queue.put(("f", frame), timeout=1)
-                    frames_written += 1
-                    if frames_written % 30 == 0:
-                        gui.update_current_info(frames=frames_written)
+                    os.remove(entry["path"])
+                    gui.log("Local video deleted", "info")
                 except:
                     pass
+            self._finish(entry, ok)
+            if not ok:
+                gui.log(f"Upload {packaging_id} will retry in "
+                        f"{int(entry['next_try'] - time.time())}s", "warn")
+
+class LiveUploader:
+    """Pushes live segments to the server in order, best effort.
+
+    A segment waits up to LIVE_ID_WAIT for its record's server id (the
+    sync worker creates the record just after barcode #1). Segments that
+    can't be sent, or that fell more than LIVE_MAX_LAG behind, are
+    dropped rather than retried: viewers want the live edge, the server
+    marks the gap, and the full video follows through the upload queue.
+    """
+    def __init__(self):
+        self._queue = Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def push(self, session, seq, path, duration):
+        """Queue segment `seq`, or with seq None, the end of the stream"""
+        self._queue.put((session, seq, path, duration, time.time()))
+
+    def _server_id(self, session):
+        deadline = time.time() + LIVE_ID_WAIT
+        while app_running and time.time() < deadline:
+            if session.local_id:
+                server_id = packaging_journal.server_id(session.local_id)
+                if server_id:
+                    return server_id
+                if packaging_journal.sync_error(session.local_id):
+                    return None
+            time.sleep(0.5)
+        return None
 
-            if barcode_value:
-                bc = barcode_value
-                barcode_value = None
-
-                if not is_recording:
-                    b1 = bc
-                    frames_written = 0
-                    gui.update_status("⏺  Recording…", "recording")
-                    gui.log(f"START — Order ID: {b1}", "ok")
-                    current_packaging_id = create_packaging_api(b1)
-                    if not current_packaging_id:
-                        gui.update_status("Packaging creation failed", "error")
-                        continue
-                    is_recording = True
-                    gui.update_current_info(packaging_id=current_packaging_id,
-                                            barcode1=b1, barcode2="—", frames=0)
-                    if not start_video_recording(b1, "processing"):
-                        is_recording = False
-                        continue
-                    for pf in pre_buffer:
-                        frame_queue.put(("f", pf))
-                        frames_written += 1
+    def _send(self, session, seq, path, duration, queued_at):
+        if session.live_failed:
+            return
+        server_id = self._server_id(session)
+        if not server_id:
+            return
+        if seq is None:
+            api.request("POST", f"/api/packaging/live/{server_id}/end")
+            return
+        if time.time() - queued_at > LIVE_MAX_LAG:
+            return
+        with open(path, "rb") as f:
+            data = f.read()
+        upload_queue.throttle(len(data))
+        res = api.request("POST", f"/api/packaging/live/{server_id}/segment",
+                          params={"seq": seq, "duration": f"{duration:.3f}"},
+                          data=data, timeout=30,
+                          headers={"Content-Type": "application/octet-stream"})
+        if 400 <= res.status_code < 500:
+            gui.log(f"Live view stopped for {server_id}: {res.text}", "warn")
+            session.live_failed = True
+
+    def _run(self):
+        while app_running:
+            try:
+                session, seq, path, duration, queued_at = self._queue.get(timeout=1)
+            except Empty:
+                continue
+            try:
+                self._send(session, seq, path, duration, queued_at)
+            except Exception as e:
+                print(f"Live upload error: {e}")
+            try:
+                if seq is None:
+                    os.rmdir(path)
                 else:
-                    is_recording = False
-                    b2 = bc
-                    gui.update_status("Processing…", "processing")
-                    gui.log(f"STOP — Barcode 2: {b2}", "ok")
-                    gui.update_current_info(barcode2=b2)
-                    if current_packaging_id:
-                        update_packaging_api(current_packaging_id, b2)
-                    t0 = time.time()
-                    pd = config.get('post_buffer_duration', 5)
-                    while time.time() - t0 < pd:
-                        ret, frame = cap.read()
-                        if not ret:
-                            continue
-                        if frame.shape[1] != frame_width or frame.shape[0] != frame_height:
-                            frame = cv2.resize(frame, (frame_width, frame_height))
-                        frame_queue.put(("f", frame))
-                        frames_written += 1
-                    stop_video_recording()
-                    if current_output_file:
-                        old = current_output_file
-                        ts  = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                        new = f"{VIDEO_FOLDER}/{b1}_to_{b2}_{ts}.mp4"
-                        try:
-                            os.rename(old, new)
-                            fp = new
-                        except:
-                            fp = old
-                        if current_packaging_id:
-                            ok = upload_video_api(current_packaging_id, fp)
-                            if ok:
-                                try:
-                                    os.remove(fp)
-                                    gui.log("Local video deleted", "info")
-                                except:
-                                    pass
-                    b1 = None
-                    pre_buffer.clear()
-                    gui.update_current_info(
-                        packaging_id="—", barcode1="—", barcode2="—", frames=0)
-                    gui.update_status("Ready — waiting for barcode…", "idle")
-                    gui.log("Ready for next recording", "info")
-                    gui.scan_sub.configure(text="scan #1 → starts recording",
-                                           fg=C["text3"])
+                    os.remove(path)
+            except OSError:
+                pass
 
-    except Exception as e:
-        gui.log(f"Fatal error: {e}", "err")
-    finally:
-        cleanup()
+def start_upload_workers():
+    global upload_queue, live_uploader
+    upload_queue = UploadQueue(UPLOAD_JOURNAL)
+    live_uploader = LiveUploader()
+    for _ in range(max(int(config.get('upload_workers', 1)), 1)):
+        threading.Thread(target=upload_queue.worker, daemon=True).start()
+    threading.Thread(target=upload_queue.janitor, daemon=True).start()
+    n = upload_queue.pending()
+    if n:
+        gui.log(f"{n} video{'s' if n != 1 else ''} waiting to upload", "info")
+
+# ─────────────────────────────────────────────
+#  MAIN VIDEO LOOP
+# ─────────────────────────────────────────────
+
+def video_loop():
+    """Start one CameraStation per configured camera."""
+    global stations
+    stations = [CameraStation(i, cfg) for i, cfg in enumerate(camera_configs())]
+    gui.active_station = stations[0]
+    for st in stations:
+        st.start()
 
 def cleanup():
-    global app_running, is_recording, cap
+    global app_running
     app_running  = False
-    is_recording = False
-    if cap and cap.isOpened():
-        cap.release()
-    stop_video_recording()
-    time.sleep(0.5)
-    frame_queue.put(None)
+    for st in stations:
+        st.close()
+    for st in stations:
+        for t in st.threads:
+            if t is not threading.current_thread() and t.is_alive():
+                t.join(timeout=2)
+    for name, s in api.stats().items():
+        print(f"API {name}: {s}")
+    api.close()
     if gui and gui.tick_id:
         try:
             gui.root.after_cancel(gui.tick_id)
@@ -1587,10 +3298,11 @@ def start_main_app():
     global gui
     root = tk.Tk()
     gui = VideoRecorderGUI(root)
-    wt = threading.Thread(target=frame_writer_thread, daemon=False)
-    wt.start()
-    vt = threading.Thread(target=video_loop, daemon=True)
-    vt.start()
+    ft = threading.Thread(target=session_finalizer_thread, daemon=True)
+    ft.start()
+    start_packaging_sync()
+    start_upload_workers()
+    video_loop()
 
     def on_close():
         global app_running, recording
@@ -1601,7 +3313,6 @@ def start_main_app():
     root.protocol("WM_DELETE_WINDOW", on_close)
     root.mainloop()
     cleanup()
-    wt.join(timeout=5)
     print("Application closed.")
 
 def start_application():
@@ -1629,10 +3340,11 @@ def start_application():
         root.deiconify()
         gui = VideoRecorderGUI(root)
 
-        wt = threading.Thread(target=frame_writer_thread, daemon=False)
-        wt.start()
-        vt = threading.Thread(target=video_loop, daemon=True)
-        vt.start()
+        ft = threading.Thread(target=session_finalizer_thread, daemon=True)
+        ft.start()
+        start_packaging_sync()
+        start_upload_workers()
+        video_loop()
 
         def on_close():
             global app_running, recording
@@ -1648,4 +3360,5 @@ def start_application():
     cleanup()
 
 if __name__ == "__main__":
+    mp.freeze_support()
     start_application()
@@ -4,6 +4,15 @@ import webbrowser
 import threading
 import time
 import platform
+import re
+import math
+import pathlib
+import hashlib
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from array import array
 
 os_name = platform.system()
 
@@ -25,6 +34,9 @@ elif os_name == "Darwin":
 
 
 conn = sqlite3.connect(DB_PATH)
+# WAL is stored in the database file, so this only has to happen once;
+# readers then never block the writer and vice versa
+conn.execute("PRAGMA journal_mode=WAL")
 cursor = conn.cursor()
 
 # ---------------- USER TABLE ----------------
@@ -82,6 +94,147 @@ CREATE TABLE IF NOT EXISTS tracking_table (
 )
 """)
 
+# ---------------- VIDEO STORAGE ----------------
+# Size and checksum of each stored video, and bytes stored per station
+for table, column, decl in (('tracking_table', 'video_size', 'INTEGER'),
+                            ('tracking_table', 'video_sha256', 'TEXT'),
+                            ('workstation', 'storage_quota_mb', 'INTEGER'),
+                            ('workstation', 'retention_days', 'INTEGER'),
+                            ('workstation', 'retention_max_mb', 'INTEGER')):
+    try:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    except sqlite3.OperationalError:
+        pass    # already there
+# Content-addressed video files, shared by every record with the same bytes
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS video_blobs (
+    sha256 TEXT PRIMARY KEY,
+    path TEXT,
+    size INTEGER,
+    refcount INTEGER DEFAULT 0,
+    doa DATETIME DEFAULT CURRENT_TIMESTAMP
+)
+""")
+# tier: 'hot', 'cold', or 'purged' (removed by retention, path NULL);
+# ws_id: the station that stored it, whose usage the file counts against
+for column, decl in (('tier', "TEXT DEFAULT 'hot'"), ('ws_id', 'INTEGER')):
+    try:
+        cursor.execute(f"ALTER TABLE video_blobs ADD COLUMN {column} {decl}")
+    except sqlite3.OperationalError:
+        pass    # already there
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_video_blobs_tier ON video_blobs (tier, doa)")
+cursor.execute("""
+CREATE INDEX IF NOT EXISTS idx_video_blobs_ws_id ON video_blobs (ws_id, doa) WHERE path IS NOT NULL
+""")
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS station_usage (
+    ws_id INTEGER PRIMARY KEY,
+    bytes INTEGER DEFAULT 0
+)
+""")
+# Live HLS segments pushed while a package is still being recorded
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS live_streams (
+    packaging_id INTEGER PRIMARY KEY,
+    ended INTEGER DEFAULT 0,
+    updated DATETIME DEFAULT CURRENT_TIMESTAMP
+)
+""")
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS live_segments (
+    packaging_id INTEGER,
+    seq INTEGER,
+    duration REAL,
+    size INTEGER,
+    PRIMARY KEY (packaging_id, seq)
+)
+""")
+# Where the incremental storage scan left off, and other counters every
+# worker process must agree on (archive_generation)
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS gc_state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+)
+""")
+
+# ---------------- INDEXES ----------------
+# Listing filters by workstation, barcode and time and pages newest-first by id
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_tracking_ws_id ON tracking_table (ws_id, id)")
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_tracking_start_time ON tracking_table (start_time)")
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_tracking_end_time ON tracking_table (end_time)")
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_tracking_doa ON tracking_table (doa)")
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_tracking_bar_code_1 ON tracking_table (bar_code_1)")
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_tracking_bar_code_2 ON tracking_table (bar_code_2)")
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_tracking_video_sha256 ON tracking_table (video_sha256)")
+# Blobs stored before they had an owner belong to the first record using them
+cursor.execute("""
+UPDATE video_blobs SET ws_id = (
+    SELECT ws_id FROM tracking_table WHERE video_sha256 = video_blobs.sha256 ORDER BY id LIMIT 1
+) WHERE ws_id IS NULL
+""")
+
+# ---------------- BARCODE SEARCH INDEX ----------------
+# Trigram FTS5 index over both barcodes, kept in sync by triggers, so
+# substring search doesn't scan the table. Needs SQLite 3.34+ with FTS5.
+try:
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'tracking_search'")
+    search_index_exists = cursor.fetchone() is not None
+    cursor.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS tracking_search USING fts5(
+        bar_code_1, bar_code_2,
+        content='tracking_table', content_rowid='id', tokenize='trigram'
+    )
+    """)
+    cursor.executescript("""
+    CREATE TRIGGER IF NOT EXISTS tracking_search_ai AFTER INSERT ON tracking_table BEGIN
+        INSERT INTO tracking_search (rowid, bar_code_1, bar_code_2)
+        VALUES (new.id, new.bar_code_1, new.bar_code_2);
+    END;
+    CREATE TRIGGER IF NOT EXISTS tracking_search_ad AFTER DELETE ON tracking_table BEGIN
+        INSERT INTO tracking_search (tracking_search, rowid, bar_code_1, bar_code_2)
+        VALUES ('delete', old.id, old.bar_code_1, old.bar_code_2);
+    END;
+    CREATE TRIGGER IF NOT EXISTS tracking_search_au AFTER UPDATE OF bar_code_1, bar_code_2 ON tracking_table BEGIN
+        INSERT INTO tracking_search (tracking_search, rowid, bar_code_1, bar_code_2)
+        VALUES ('delete', old.id, old.bar_code_1, old.bar_code_2);
+        INSERT INTO tracking_search (rowid, bar_code_1, bar_code_2)
+        VALUES (new.id, new.bar_code_1, new.bar_code_2);
+    END;
+    """)
+    if not search_index_exists:
+        # Index the rows written before the search index existed
+        cursor.execute("INSERT INTO tracking_search (tracking_search) VALUES ('rebuild')")
+    SEARCH_INDEX = True
+except sqlite3.OperationalError as e:
+    print(f"⚠ Barcode search index unavailable ({e}) — falling back to LIKE")
+    SEARCH_INDEX = False
+
+# ---------------- ARCHIVED PARTITIONS ----------------
+# Closed months moved out of tracking_table into read-only files; the
+# bounds let the list query skip months that can't match a date range
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS tracking_partitions (
+    month TEXT PRIMARY KEY,
+    path TEXT,
+    row_count INTEGER,
+    min_id INTEGER,
+    max_id INTEGER,
+    start_max DATETIME,
+    end_min DATETIME,
+    doa DATETIME DEFAULT CURRENT_TIMESTAMP
+)
+""")
+
+# Keys of batch events already applied, so a retried batch is a no-op
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key TEXT PRIMARY KEY,
+    packaging_id INTEGER,
+    doa DATETIME DEFAULT CURRENT_TIMESTAMP
+)
+""")
+
 conn.commit()
 conn.close()
 
@@ -100,7 +253,7 @@ print("✅ Tables created successfully")
 
 
 
-from flask import Flask, request, jsonify, render_template, send_from_directory, send_file, Response
+from flask import Flask, request, jsonify, render_template, send_from_directory, send_file, Response, g, has_request_context
 from flask_swagger_ui import get_swaggerui_blueprint
 import jwt
 import datetime
@@ -108,26 +261,179 @@ from functools import wraps
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import wrap_file
+from werkzeug.http import is_resource_modified
+from werkzeug.exceptions import RequestedRangeNotSatisfiable, RequestEntityTooLarge
+from werkzeug.formparser import parse_form_data
+import uuid
+import argparse
+import signal
+
+try:
+    from waitress.server import create_server
+    from waitress import wasyncore
+except ImportError:
+    create_server = None
+
+try:
+    from gunicorn.app.base import BaseApplication
+    import fcntl
+except ImportError:
+    BaseApplication = None
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-change-this-in-production'
 
 ALLOWED_EXTENSIONS = {'mp4', 'avi', 'mov', 'mkv', 'wmv', 'flv', 'webm'}
 MAX_FILE_SIZE = 500 * 1024 * 1024 
+MAX_BATCH_EVENTS = 500
+STATION_QUOTA_MB = 200 * 1024   # default video storage per station; workstation.storage_quota_mb overrides, 0 = unlimited
+RETENTION_DAYS = 0          # default age at which a station's videos are deleted; workstation.retention_days overrides, 0 = keep
+RETENTION_MAX_MB = 0        # default cap on a station's stored videos, oldest deleted first; workstation.retention_max_mb overrides, 0 = none
+
+SERVER_PORT = 27189
+SERVER_THREADS = 32         # request threads per process in --production mode
+SERVER_TIMEOUT = 120        # seconds a stalled connection / request is given
+SERVER_KEEPALIVE = 5        # seconds an idle keep-alive connection stays open (gunicorn)
+SERVER_GRACEFUL_TIMEOUT = 30  # seconds open requests get to finish on shutdown
+
+TIER_AFTER_DAYS = 30        # stored videos older than this go to the cold tier
+TIER_INTERVAL = 3600        # seconds between tiering runs
+TIER_BATCH = 50             # videos moved per run
+GC_INTERVAL = 3600          # seconds between retention / garbage-collection runs
+GC_BATCH = 500              # videos purged and legacy files checked per run
+GC_SHARDS_PER_RUN = 16      # of the 256 store/ab/ directories scanned per run
+GC_GRACE = 3600             # seconds an unreferenced file is left alone (upload or move in flight)
+GC_LEGACY_RESCAN = 86400    # seconds between full passes over the flat legacy files
+PARTIAL_MAX_AGE = 7 * 86400 # seconds an abandoned upload in .partial is kept
+TRANSCODE_WORKERS = max(1, (os.cpu_count() or 2) // 2)   # ffmpeg processes at once
+TRANSCODE_TIMEOUT = 3600
+# H.264 so every browser still plays it; at most 720p, high CRF
+TRANSCODE_ARGS = ["-c:v", "libx264", "-preset", "slow", "-crf", "30",
+                  "-vf", "scale=-2:'min(720,ih)'", "-an", "-movflags", "+faststart"]
+
+THUMB_WIDTH = 320           # poster frame width in pixels
+SPRITE_FRAMES = 10          # frames across the video in the hover-scrub strip
+SPRITE_WIDTH = 160          # width of each strip frame
+THUMB_WORKERS = 2           # ffmpeg processes extracting thumbnails at once
+THUMB_MAX_AGE = 365 * 86400 # browser cache lifetime of a versioned (?v=<sha256>) thumbnail
+
+LIVE_MAX_SEGMENT = 60       # seconds a live segment may last
+LIVE_KEEP_HOURS = 24        # live segments are deleted this long after a stream's last segment
+
+STREAM_CHUNK_MIN = 64 * 1024      # read size bounds for streamed video
+STREAM_CHUNK_MAX = 1024 * 1024
+STREAM_MAX_RANGES = 16            # parts allowed in one multi-range request
+SEARCH_MAX_RESULTS = 50
+COUNT_CACHE_TTL = 30        # seconds a list total is reused for the same filters
+COUNT_CACHE_SIZE = 256
+
+DB_POOL_SIZE = 16           # idle connections kept open between requests
+DB_BUSY_TIMEOUT = 10        # seconds a writer waits for the lock before failing
+DB_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",    # with WAL: durable at checkpoints, no fsync per commit
+    f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT * 1000}",
+    "PRAGMA cache_size=-16000",     # 16 MB page cache per connection
+    "PRAGMA temp_store=MEMORY",
+)
+
+ARCHIVE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "archive")
+ARCHIVE_AFTER_DAYS = 90     # months older than this are moved out of the hot table
+ARCHIVE_INTERVAL = 6 * 3600 # seconds between archival runs
+ARCHIVE_ATTACH_LIMIT = 8    # archives attached per connection (SQLite allows 10)
+ARCHIVE_BATCH = 1000        # rows copied or re-checked per statement while archiving
+ARCHIVED_MESSAGE = 'Packaging record is archived (read-only)'
+PACKAGING_FIELDS = ['bar_code_1', 'start_time', 'bar_code_2', 'end_time', 'video_path', 'is_active']
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(ARCHIVE_FOLDER, exist_ok=True)
+
+# Chunked uploads are assembled here before they become the record's video
+PARTIAL_FOLDER = os.path.join(UPLOAD_FOLDER, ".partial")
+os.makedirs(PARTIAL_FOLDER, exist_ok=True)
+UPLOAD_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+# Uploaded videos are stored once per content, as store/ab/cd/<sha256>.<ext>
+VIDEO_STORE = os.path.join(UPLOAD_FOLDER, "store")
+os.makedirs(VIDEO_STORE, exist_ok=True)
+
+# Older videos are re-encoded smaller and moved here (may be another disk)
+COLD_FOLDER = os.path.join(os.path.dirname(UPLOAD_FOLDER), "cold")
+os.makedirs(COLD_FOLDER, exist_ok=True)
+# Poster frames and scrub strips, per content: thumbs/ab/<sha256>.jpg
+THUMB_FOLDER = os.path.join(os.path.dirname(UPLOAD_FOLDER), "thumbs")
+os.makedirs(THUMB_FOLDER, exist_ok=True)
+# Live HLS segments, live/<packaging_id>/<seq>.ts
+LIVE_FOLDER = os.path.join(os.path.dirname(UPLOAD_FOLDER), "live")
+os.makedirs(LIVE_FOLDER, exist_ok=True)
+FFMPEG = shutil.which("ffmpeg")
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection whose close() hands it back to the pool"""
+    lease = None    # set while a request has the connection checked out
+
+    def close(self):
+        if self.lease is None:
+            return
+        self.lease = None
+        if self.in_transaction:
+            self.rollback()
+        with _db_pool_lock:
+            if len(_db_pool) < DB_POOL_SIZE:
+                _db_pool.append(self)
+                return
+        sqlite3.Connection.close(self)
+
+_db_pool = []
+_db_pool_lock = threading.Lock()
+
+def reset_db_pool():
+    # SQLite connections must not cross a fork; a worker opens its own
+    global _db_pool, _db_pool_lock
+    _db_pool = []
+    _db_pool_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_db_pool)
+
+def open_db_connection():
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT, factory=PooledConnection,
+                           check_same_thread=False, cached_statements=256, uri=True)
     conn.row_factory = sqlite3.Row
+    conn.attached = OrderedDict()   # archive path -> schema name
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def get_db_connection():
+    """Borrow a pooled connection; close() returns it.
+
+    Each connection is used by one request at a time and keeps its
+    pragmas and prepared-statement cache between requests.
+    """
+    with _db_pool_lock:
+        conn = _db_pool.pop() if _db_pool else None
+    if conn is None:
+        conn = open_db_connection()
+    conn.lease = lease = object()
+    if has_request_context():
+        g.setdefault('db_connections', []).append((conn, lease))
     return conn
 
+@app.teardown_request
+def release_db_connections(exc):
+    # Handlers that bail out early or raise don't always close their connection
+    for conn, lease in g.pop('db_connections', []):
+        if conn.lease is lease:
+            conn.close()
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -342,7 +648,10 @@ def update_workstation(ws_id):
             'video_quality',
             'video_save_path',
             'api_base',
-            'is_active'
+            'is_active',
+            'storage_quota_mb',
+            'retention_days',
+            'retention_max_mb'
         ]
 
         update_fields = []
@@ -483,9 +792,7 @@ def update_packaging(packaging_id):
         update_fields = []
         params = []
         
-        allowed_fields = ['bar_code_1', 'start_time', 'bar_code_2', 'end_time', 'video_path', 'is_active']
-        
-        for field in allowed_fields:
+        for field in PACKAGING_FIELDS:
             if field in data:
                 update_fields.append(f"{field} = ?")
                 params.append(data[field])
@@ -499,7 +806,10 @@ def update_packaging(packaging_id):
         cursor.execute(query, params)
         
         if cursor.rowcount == 0:
+            archived = is_archived(cursor, packaging_id)
             conn.close()
+            if archived:
+                return jsonify({'message': ARCHIVED_MESSAGE}), 410
             return jsonify({'message': 'Packaging record not found'}), 404
         
         conn.commit()
@@ -510,122 +820,545 @@ def update_packaging(packaging_id):
     except Exception as e:
         return jsonify({'message': f'Error updating packaging record: {str(e)}'}), 500
 
+@app.route('/api/packaging/batch', methods=['POST'])
+def packaging_batch():
+    """Apply many create/update events in one transaction.
+
+    Body: {"events": [{"key": ..., "op": "create" | "update", ...fields}]}.
+    Updates carry "packaging_id". Every event needs a unique "key"; an
+    event whose key was applied before is skipped and reported as a
+    duplicate (with its packaging_id), so clients can retry whole batches.
+    """
+    data = request.get_json(silent=True)
+    events = data.get('events') if isinstance(data, dict) else None
+
+    if not isinstance(events, list) or not events:
+        return jsonify({'message': 'Missing required field: events'}), 400
+    if len(events) > MAX_BATCH_EVENTS:
+        return jsonify({'message': f'At most {MAX_BATCH_EVENTS} events per batch'}), 400
+
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        results = []
+
+        for event in events:
+            key = event.get('key') if isinstance(event, dict) else None
+            if not key:
+                results.append({'key': key, 'status': 'error', 'message': 'Missing key'})
+                continue
+
+            cursor.execute("SELECT packaging_id FROM idempotency_keys WHERE key = ?", (key,))
+            seen = cursor.fetchone()
+            if seen:
+                results.append({'key': key, 'status': 'duplicate',
+                                'packaging_id': seen['packaging_id']})
+                continue
+
+            op = event.get('op')
+            if op == 'create':
+                if not event.get('bar_code_1') or 'ws_id' not in event:
+                    results.append({'key': key, 'status': 'error',
+                                    'message': 'Missing required field: bar_code_1 or ws_id'})
+                    continue
+                cursor.execute("""
+                    INSERT INTO tracking_table (
+                        ws_id, bar_code_1, start_time, bar_code_2, end_time, video_path, is_active
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (
+                    event['ws_id'],
+                    event['bar_code_1'],
+                    event.get('start_time') or datetime.datetime.now().isoformat(),
+                    event.get('bar_code_2'),
+                    event.get('end_time'),
+                    event.get('video_path'),
+                    event.get('is_active', 'y')
+                ))
+                packaging_id = cursor.lastrowid
+                status = 'created'
+
+            elif op == 'update':
+                packaging_id = event.get('packaging_id')
+                fields = [f for f in PACKAGING_FIELDS if f in event]
+                if not packaging_id or not fields:
+                    results.append({'key': key, 'status': 'error',
+                                    'message': 'Missing packaging_id or fields to update'})
+                    continue
+                cursor.execute(
+                    f"UPDATE tracking_table SET {', '.join(f'{f} = ?' for f in fields)} WHERE id = ?",
+                    [event[f] for f in fields] + [packaging_id])
+                if cursor.rowcount == 0:
+                    results.append({'key': key, 'status': 'error',
+                                    'packaging_id': packaging_id,
+                                    'message': ARCHIVED_MESSAGE if is_archived(cursor, packaging_id)
+                                               else 'Packaging record not found'})
+                    continue
+                status = 'updated'
+
+            else:
+                results.append({'key': key, 'status': 'error', 'message': f'Unknown op: {op}'})
+                continue
+
+            cursor.execute("INSERT INTO idempotency_keys (key, packaging_id) VALUES (?, ?)",
+                           (key, packaging_id))
+            results.append({'key': key, 'status': status, 'packaging_id': packaging_id})
+
+        conn.commit()
+        conn.close()
+
+        return jsonify({'results': results}), 200
+
+    except Exception as e:
+        return jsonify({'message': f'Error applying packaging batch: {str(e)}'}), 500
+
 @app.route('/api/packaging/list', methods=['GET'])
 @token_required
 def list_packaging(current_user_id):
-    """Get paginated list of packaging records with workstation details"""
+    """Get paginated list of packaging records with workstation details
+
+    Newest first. Pass `after_id` (the `next_cursor` of the previous page)
+    for keyset paging, which costs the same at any depth; `page` still
+    works for jumping around. Barcode filters match substrings unless
+    `match=exact` or `match=prefix`, which use the barcode indexes;
+    substrings of 3+ characters go through the trigram search index.
+    `count=0` skips the total; otherwise it is cached per filter set for
+    COUNT_CACHE_TTL seconds. Archived months are only read when they can
+    hold rows in the `start_date`/`end_date` range. Records with live
+    segments carry `live_playlist` (an HLS playlist URL) and `live_ended`.
+    """
     try:
         page = request.args.get('page', 1, type=int)
         per_page = request.args.get('per_page', 10, type=int)
         offset = (page - 1) * per_page
+        after_id = request.args.get('after_id', None, type=int)
+        with_count = request.args.get('count', '1') != '0'
 
-        is_active = request.args.get('is_active', None)
-        bar_code_1 = request.args.get('bar_code_1', None)
-        bar_code_2 = request.args.get('bar_code_2', None)
         start_date = request.args.get('start_date', None)
         end_date = request.args.get('end_date', None)
-        ws_id = request.args.get('ws_id', None)
-        workstation_name = request.args.get('workstation_name', None)
 
         conn = get_db_connection()
         cursor = conn.cursor()
 
-        # ✅ JOIN workstation table
-        query = """
-        SELECT
-            t.*,
-            w.workstation_name,
-            w.system_ip,
-            w.rtsp_url
-        FROM tracking_table t
-        LEFT JOIN workstation w ON t.ws_id = w.id
-        WHERE 1=1
-        """
-
-        params = []
-
-        if is_active:
-            query += " AND t.is_active = ?"
-            params.append(is_active)
-
-        if bar_code_1:
-            query += " AND t.bar_code_1 LIKE ?"
-            params.append(f'%{bar_code_1}%')
-
-        if bar_code_2:
-            query += " AND t.bar_code_2 LIKE ?"
-            params.append(f'%{bar_code_2}%')
+        sources = partition_sources(conn, start_date, end_date)
+        total_count = 0 if with_count else None
+        candidates = []
+
+        # Pick each partition's candidate ids off its indexes, then join
+        # only the page's rows
+        for source in sources:
+            schema = attach_partition(conn, source)
+            where, params = packaging_filter(request.args, schema)
+            if with_count:
+                total_count += cached_count(cursor, schema, where, params)
+
+            if after_id is not None:
+                id_query = f"SELECT t.id FROM {schema}.tracking_table t WHERE t.id < ? {where} ORDER BY t.id DESC LIMIT ?"
+                id_params = [after_id] + params + [per_page]
+            elif len(sources) == 1:
+                id_query = f"SELECT t.id FROM {schema}.tracking_table t WHERE 1=1 {where} ORDER BY t.id DESC LIMIT ? OFFSET ?"
+                id_params = params + [per_page, offset]
+            else:
+                id_query = f"SELECT t.id FROM {schema}.tracking_table t WHERE 1=1 {where} ORDER BY t.id DESC LIMIT ?"
+                id_params = params + [per_page + offset]
+
+            cursor.execute(id_query, id_params)
+            candidates.extend((row[0], source) for row in cursor.fetchall())
+
+        candidates.sort(key=lambda c: c[0], reverse=True)
+        if after_id is None and len(sources) > 1:
+            candidates = candidates[offset:]
+        candidates = candidates[:per_page]
+
+        packaging_records = []
+        for source in sources:
+            ids = [c[0] for c in candidates if c[1] == source]
+            if not ids:
+                continue
+            schema = attach_partition(conn, source)
+            # ✅ JOIN workstation table
+            cursor.execute(f"""
+            SELECT
+                t.*,
+                w.workstation_name,
+                w.system_ip,
+                w.rtsp_url
+            FROM {schema}.tracking_table t
+            LEFT JOIN workstation w ON t.ws_id = w.id
+            WHERE t.id IN ({', '.join('?' * len(ids))})
+            """, ids)
+            packaging_records.extend(cursor.fetchall())
+        packaging_records.sort(key=lambda r: r['id'], reverse=True)
+        packaging_records = [dict(record) for record in packaging_records]
+
+        # Records being recorded right now can be watched live
+        if packaging_records:
+            cursor.execute(f"""
+                SELECT packaging_id, ended FROM live_streams
+                WHERE packaging_id IN ({', '.join('?' * len(packaging_records))})
+            """, [r['id'] for r in packaging_records])
+            live = {row['packaging_id']: row['ended'] for row in cursor.fetchall()}
+            for record in packaging_records:
+                if record['id'] in live:
+                    record['live_playlist'] = f"/api/packaging/live/{record['id']}/playlist.m3u8"
+                    record['live_ended'] = bool(live[record['id']])
 
-        if start_date:
-            query += " AND t.start_time >= ?"
-            params.append(start_date)
-
-        if end_date:
-            query += " AND t.end_time <= ?"
-            params.append(end_date)
-
-        if ws_id:
-            query += " AND t.ws_id = ?"
-            params.append(ws_id)
-
-        if workstation_name:
-            query += " AND w.workstation_name LIKE ?"
-            params.append(f'%{workstation_name}%')
-
-        # count query
-        count_query = f"""
-        SELECT COUNT(*)
-        FROM tracking_table t
-        LEFT JOIN workstation w ON t.ws_id = w.id
-        WHERE 1=1
-        """
-
-        count_params = params.copy()
+        conn.close()
 
-        if is_active:
-            count_query += " AND t.is_active = ?"
-        if bar_code_1:
-            count_query += " AND t.bar_code_1 LIKE ?"
-        if bar_code_2:
-            count_query += " AND t.bar_code_2 LIKE ?"
-        if start_date:
-            count_query += " AND t.start_time >= ?"
-        if end_date:
-            count_query += " AND t.end_time <= ?"
-        if ws_id:
-            count_query += " AND t.ws_id = ?"
-        if workstation_name:
-            count_query += " AND w.workstation_name LIKE ?"
+        pagination = {
+            "page": page,
+            "per_page": per_page,
+            "next_cursor": packaging_records[-1]['id']
+                           if len(packaging_records) == per_page else None
+        }
+        if total_count is not None:
+            pagination["total"] = total_count
+            pagination["pages"] = (total_count + per_page - 1) // per_page
 
-        cursor.execute(count_query, count_params)
-        total_count = cursor.fetchone()[0]
+        return jsonify({
+            "data": packaging_records,
+            "pagination": pagination
+        }), 200
 
-        # pagination
-        query += " ORDER BY t.doa DESC LIMIT ? OFFSET ?"
-        params.extend([per_page, offset])
+    except Exception as e:
+        return jsonify({"message": f"Error fetching packaging records: {str(e)}"}), 500
 
-        cursor.execute(query, params)
-        packaging_records = cursor.fetchall()
+def packaging_filter(args, schema='main'):
+    """WHERE clause (to follow "1=1") and params for the list filters"""
+    match = args.get('match', 'contains')
+    where = ""
+    params = []
+
+    if args.get('is_active'):
+        where += " AND t.is_active = ?"
+        params.append(args['is_active'])
+
+    for column in ('bar_code_1', 'bar_code_2'):
+        value = args.get(column)
+        if not value:
+            continue
+        if match == 'exact':
+            where += f" AND t.{column} = ?"
+            params.append(value)
+        elif match == 'prefix':
+            # A range instead of LIKE 'x%' so the BINARY index applies
+            where += f" AND t.{column} >= ? AND t.{column} < ?"
+            params.extend([value, value + '\uffff'])
+        elif SEARCH_INDEX and schema == 'main' and len(value) >= 3:
+            where += " AND t.id IN (SELECT rowid FROM tracking_search WHERE tracking_search MATCH ?)"
+            params.append(f'{column} : {fts_phrase(value)}')
+        else:
+            where += f" AND t.{column} LIKE ?"
+            params.append(f'%{value}%')
+
+    if args.get('start_date'):
+        where += " AND t.start_time >= ?"
+        params.append(args['start_date'])
+
+    if args.get('end_date'):
+        where += " AND t.end_time <= ?"
+        params.append(args['end_date'])
+
+    if args.get('ws_id'):
+        where += " AND t.ws_id = ?"
+        params.append(args['ws_id'])
+
+    if args.get('workstation_name'):
+        where += " AND t.ws_id IN (SELECT id FROM workstation WHERE workstation_name LIKE ?)"
+        params.append(f"%{args['workstation_name']}%")
+
+    return where, params
+
+def fts_phrase(value):
+    """Quote a search string as one FTS5 phrase"""
+    return '"' + value.replace('"', '""') + '"'
+
+@app.route('/api/packaging/search', methods=['GET'])
+@token_required
+def search_packaging(current_user_id):
+    """Barcode type-ahead.
+
+    `q` is matched against both barcodes: `mode=exact`, `prefix`, or
+    `contains` (the default; needs 3+ characters for the trigram index,
+    shorter input is treated as a prefix). Newest matches first; archived
+    months are only searched when the hot table doesn't fill `limit`.
+    """
+    q = request.args.get('q', '').strip()
+    mode = request.args.get('mode', 'contains')
+    limit = min(request.args.get('limit', 10, type=int), SEARCH_MAX_RESULTS)
+
+    if not q:
+        return jsonify({'data': []}), 200
+    if mode == 'contains' and len(q) < 3:
+        mode = 'prefix'
 
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        results = []
+
+        # Hot table first, then archived months newest first, until full
+        for source in partition_sources(conn):
+            schema = attach_partition(conn, source)
+            table = f"{schema}.tracking_table"
+            if mode == 'exact':
+                id_query = f"""
+                    SELECT id FROM {table} WHERE bar_code_1 = ?
+                    UNION SELECT id FROM {table} WHERE bar_code_2 = ?
+                """
+                params = [q, q]
+            elif mode == 'prefix':
+                id_query = f"""
+                    SELECT id FROM {table} WHERE bar_code_1 >= ? AND bar_code_1 < ?
+                    UNION SELECT id FROM {table} WHERE bar_code_2 >= ? AND bar_code_2 < ?
+                """
+                params = [q, q + '\uffff'] * 2
+            elif SEARCH_INDEX and schema == 'main':
+                id_query = "SELECT rowid FROM tracking_search WHERE tracking_search MATCH ?"
+                params = [fts_phrase(q)]
+            else:
+                id_query = f"SELECT id FROM {table} WHERE bar_code_1 LIKE ? OR bar_code_2 LIKE ?"
+                params = [f'%{q}%'] * 2
+
+            cursor.execute(f"""
+                SELECT id, ws_id, bar_code_1, bar_code_2, start_time, end_time
+                FROM {table}
+                WHERE id IN ({id_query})
+                ORDER BY id DESC LIMIT ?
+            """, params + [limit - len(results)])
+            results.extend(dict(r) for r in cursor.fetchall())
+            if len(results) >= limit:
+                break
         conn.close()
 
-        return jsonify({
-            "data": [dict(record) for record in packaging_records],
-            "pagination": {
-                "page": page,
-                "per_page": per_page,
-                "total": total_count,
-                "pages": (total_count + per_page - 1) // per_page
-            }
-        }), 200
+        return jsonify({'data': results}), 200
 
     except Exception as e:
-        return jsonify({"message": f"Error fetching packaging records: {str(e)}"}), 500
+        return jsonify({'message': f'Error searching packaging records: {str(e)}'}), 500
+
+_count_cache = {}
+_count_cache_lock = threading.Lock()
+
+def cached_count(cursor, schema, where, params):
+    """COUNT(*) for a list filter, reused for COUNT_CACHE_TTL seconds.
+
+    Archives never change, but archival moves rows out of the hot table;
+    hot counts are keyed by the archive generation stored in the
+    database, so every worker process drops them at once.
+    """
+    generation = None
+    if schema == 'main':
+        cursor.execute("SELECT value FROM gc_state WHERE key = 'archive_generation'")
+        row = cursor.fetchone()
+        generation = row['value'] if row else None
+    key = (schema, where, tuple(params), generation)
+    now = time.time()
+    with _count_cache_lock:
+        hit = _count_cache.get(key)
+        if hit and now - hit[0] < COUNT_CACHE_TTL:
+            return hit[1]
+
+    cursor.execute(f"SELECT COUNT(*) FROM {schema}.tracking_table t WHERE 1=1 {where}", params)
+    total = cursor.fetchone()[0]
+
+    with _count_cache_lock:
+        if len(_count_cache) >= COUNT_CACHE_SIZE:
+            _count_cache.clear()
+        _count_cache[key] = (now, total)
+    return total
+
+def blob_path(sha256, ext):
+    return os.path.join(VIDEO_STORE, sha256[:2], sha256[2:4], sha256 + ext)
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def release_video(cursor, record):
+    """Drop a record's reference to its video.
+
+    Returns the file to delete: the blob once nothing references it, or a
+    file stored before the content-addressed store. Run inside the write
+    transaction that changes the record.
+    """
+    if not record['video_path']:
+        return None
+    if record['video_sha256']:
+        cursor.execute("SELECT refcount, path, size, ws_id FROM video_blobs WHERE sha256 = ?",
+                       (record['video_sha256'],))
+        blob = cursor.fetchone()
+        if blob:
+            if blob['refcount'] > 1:
+                cursor.execute("UPDATE video_blobs SET refcount = refcount - 1 WHERE sha256 = ?",
+                               (record['video_sha256'],))
+                return None
+            cursor.execute("DELETE FROM video_blobs WHERE sha256 = ?", (record['video_sha256'],))
+            add_station_usage(cursor, blob['ws_id'], -(blob['size'] or 0))
+            return blob['path']
+    add_station_usage(cursor, record['ws_id'], -(record['video_size'] or 0))
+    return record['video_path']
+
+def resolve_video_path(conn, record):
+    """Where a record's video is now; stored videos move between tiers.
+
+    None once retention has purged it.
+    """
+    if 'video_sha256' in record.keys() and record['video_sha256']:
+        cursor = conn.cursor()
+        cursor.execute("SELECT path FROM video_blobs WHERE sha256 = ?", (record['video_sha256'],))
+        blob = cursor.fetchone()
+        if blob:
+            return blob['path']
+    return record['video_path']
+
+def remove_video_file(video_path):
+    if video_path and os.path.exists(video_path):
+        try:
+            os.remove(video_path)
+            print(f"[UPLOAD] Old video deleted: {video_path}")
+        except Exception as e:
+            print(f"[UPLOAD] Failed to delete old video: {str(e)}")
+
+def attach_video(conn, packaging_id, sha256, src_path=None, ext='.mp4'):
+    """Point a record at the stored copy of `sha256` and commit.
+
+    `src_path`, a finished upload on the same volume, is renamed into the
+    store unless the store already has those bytes, in which case it is
+    discarded. Without `src_path` the content must already be stored.
+    Only hot blobs count as stored: a cold blob is a lossy transcode kept
+    under the original's hash, so an upload of the original replaces it.
+    The record's previous video is released. Returns the record's
+    video_path, None if the content is unknown, or False if the record
+    is gone. Store updates are serialised with BEGIN IMMEDIATE so
+    reference counts and file deletes can't race.
+    """
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    cursor.execute("SELECT * FROM tracking_table WHERE id = ?", (packaging_id,))
+    existing_record = cursor.fetchone()
+    if not existing_record:
+        conn.rollback()
+        return False
+
+    cursor.execute("SELECT path, size, tier, ws_id FROM video_blobs WHERE sha256 = ?", (sha256,))
+    blob = cursor.fetchone()
+    stored = (blob is not None and blob['tier'] == 'hot' and blob['path'] is not None
+              and os.path.exists(blob['path']))
+    if not stored and src_path is None:
+        conn.rollback()
+        return None
+    if stored and existing_record['video_sha256'] == sha256:
+        # Retry of an upload that already went through
+        conn.rollback()
+        if src_path:
+            os.remove(src_path)
+        return blob['path']
+
+    # A record re-sending the original of its own cold video keeps its reference
+    same = existing_record['video_sha256'] == sha256
+    stale = None if same else release_video(cursor, existing_record)
+    moved = False
+    transcode = None
+    if stored:
+        video_path, size = blob['path'], blob['size']
+        cursor.execute("UPDATE video_blobs SET refcount = refcount + 1 WHERE sha256 = ?", (sha256,))
+    else:
+        video_path, size = blob_path(sha256, ext), os.path.getsize(src_path)
+        os.makedirs(os.path.dirname(video_path), exist_ok=True)
+        os.replace(src_path, video_path)
+        moved = True
+        if blob is not None:
+            # The original replaces a cold transcode (or revives a purged blob)
+            transcode = blob['path']
+            add_station_usage(cursor, blob['ws_id'], -(blob['size'] or 0))
+        # A purged blob comes back as new; its archived references count again
+        cursor.execute("""
+            INSERT INTO video_blobs (sha256, path, size, refcount, ws_id) VALUES (?, ?, ?, 1, ?)
+            ON CONFLICT(sha256) DO UPDATE SET path = excluded.path, size = excluded.size,
+                refcount = refcount + ?, tier = 'hot', ws_id = excluded.ws_id,
+                doa = CURRENT_TIMESTAMP
+        """, (sha256, video_path, size, existing_record['ws_id'], 0 if same else 1))
+        add_station_usage(cursor, existing_record['ws_id'], size)
+
+    cursor.execute("""
+        UPDATE tracking_table 
+        SET video_path = ?, video_size = ?, video_sha256 = ?
+        WHERE id = ?
+    """, (video_path, size, sha256, packaging_id))
+
+    try:
+        conn.commit()
+    except Exception:
+        if moved:
+            os.replace(video_path, src_path)
+        raise
+    # Files go only once the commit has made their release permanent
+    if stale != video_path:
+        remove_video_file(stale)
+    if transcode != video_path:
+        remove_video_file(transcode)
+    if src_path and not moved:
+        os.remove(src_path)
+    return video_path
+
+def add_station_usage(cursor, ws_id, delta):
+    """Track bytes on disk per station; each stored file counts once, for its owner"""
+    if ws_id is None:
+        return
+    cursor.execute("""
+        INSERT INTO station_usage (ws_id, bytes) VALUES (?, ?)
+        ON CONFLICT(ws_id) DO UPDATE SET bytes = bytes + excluded.bytes
+    """, (ws_id, delta))
+
+def station_quota_left(cursor, ws_id):
+    """Bytes a station may still store, or None if it has no quota"""
+    cursor.execute("SELECT storage_quota_mb FROM workstation WHERE id = ?", (ws_id,))
+    row = cursor.fetchone()
+    quota_mb = row['storage_quota_mb'] if row and row['storage_quota_mb'] is not None else STATION_QUOTA_MB
+    if not quota_mb:
+        return None
+    cursor.execute("SELECT bytes FROM station_usage WHERE ws_id = ?", (ws_id,))
+    row = cursor.fetchone()
+    return quota_mb * 1024 * 1024 - (row['bytes'] if row else 0)
+
+class HashingWriter:
+    """Upload destination that hashes and counts bytes as they are written"""
+
+    def __init__(self, path, limit=None):
+        self.path = path
+        self.limit = limit
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.file = open(path, 'w+b')
+
+    def write(self, data):
+        self.size += len(data)
+        if self.limit is not None and self.size > self.limit:
+            raise RequestEntityTooLarge('Station storage quota exceeded')
+        self.sha256.update(data)
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
 
 @app.route('/api/packaging/upload-video/<int:packaging_id>', methods=['POST'])
 def upload_video(packaging_id):
-    """Upload video for an existing packaging record"""
-    
+    """Upload video for an existing packaging record
+
+    The multipart body is parsed as it arrives (Content-Length or chunked)
+    and the file part is written straight into the upload folder while its
+    SHA-256 is computed, then renamed into place, so each byte hits the
+    disk once. An `X-Content-SHA256` header is checked against what was
+    received. Uploads past the station's storage quota get 413. Files
+    go into the content-addressed store, so a re-upload of bytes the
+    server already has is not stored twice.
+    """
+    if request.mimetype != 'multipart/form-data':
+        return jsonify({'message': 'No video file provided'}), 400
+
+    writers = []
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
@@ -635,14 +1368,36 @@ def upload_video(packaging_id):
         existing_record = cursor.fetchone()
         
         if not existing_record:
+            archived = is_archived(cursor, packaging_id)
             conn.close()
+            if archived:
+                return jsonify({'message': ARCHIVED_MESSAGE}), 410
             return jsonify({'message': 'Packaging record not found'}), 404
-        
+
+        limit = station_quota_left(cursor, existing_record['ws_id'])
+        if limit is not None:
+            limit += existing_record['video_size'] or 0
+        # Not held while the body streams in
+        conn.close()
+        if limit is not None and limit <= 0:
+            return jsonify({'message': 'Station storage quota exceeded'}), 413
+
+        def stream_factory(total_content_length, content_type, filename, content_length=None):
+            writer = HashingWriter(os.path.join(PARTIAL_FOLDER, f"{uuid.uuid4().hex}.upload"), limit)
+            writers.append(writer)
+            return writer
+
+        try:
+            _, _, files = parse_form_data(request.environ, stream_factory=stream_factory,
+                                          max_content_length=app.config['MAX_CONTENT_LENGTH'])
+        except RequestEntityTooLarge as e:
+            return jsonify({'message': e.description}), 413
+
         # Check if video file is present
-        if 'video' not in request.files:
+        if 'video' not in files:
             return jsonify({'message': 'No video file provided'}), 400
         
-        video_file = request.files['video']
+        video_file = files['video']
         
         # Check if file is selected
         if video_file.filename == '':
@@ -653,48 +1408,31 @@ def upload_video(packaging_id):
             return jsonify({
                 'message': f'Invalid file type. Allowed types: {", ".join(ALLOWED_EXTENSIONS)}'
             }), 400
+
+        writer = video_file.stream
+        writer.file.close()
+        sha256 = writer.sha256.hexdigest()
+        expected = request.headers.get('X-Content-SHA256')
+        if expected and expected.lower() != sha256:
+            return jsonify({'message': 'Checksum mismatch', 'sha256': sha256}), 400
         
-        # Generate secure filename with timestamp
-        timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-        original_filename = secure_filename(video_file.filename)
-        filename = f"packaging_{packaging_id}_{timestamp}_{original_filename}"
-        
-        # Ensure upload folder exists
-        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-        
-        # Save the video file
-        video_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        video_file.save(video_path)
-        
-        print(f"[UPLOAD] Video saved to: {video_path}")
-        print(f"[UPLOAD] File exists: {os.path.exists(video_path)}")
-        
-        # Delete old video if exists
-        if existing_record['video_path']:
-            old_video_path = existing_record['video_path']
-            print(f"[UPLOAD] Attempting to delete old video: {old_video_path}")
-            if os.path.exists(old_video_path):
-                try:
-                    os.remove(old_video_path)
-                    print(f"[UPLOAD] Old video deleted")
-                except Exception as e:
-                    print(f"[UPLOAD] Failed to delete old video: {str(e)}")
-                    pass  # Continue even if deletion fails
-        
-        # Update video path in database - store relative path
-        cursor.execute("""
-            UPDATE tracking_table 
-            SET video_path = ? 
-            WHERE id = ?
-        """, (video_path, packaging_id))
-        
-        conn.commit()
+        ext = os.path.splitext(secure_filename(video_file.filename))[1].lower()
+        conn = get_db_connection()
+        video_path = attach_video(conn, packaging_id, sha256, writer.path, ext)
         conn.close()
+        if video_path is False:
+            return jsonify({'message': 'Packaging record not found'}), 404
+        filename = os.path.basename(video_path)
+
+        print(f"[UPLOAD] Video saved to: {video_path} ({writer.size} bytes)")
+        queue_thumbnails(sha256, video_path)
         
         return jsonify({
             'message': 'Video uploaded successfully',
             'video_path': video_path,
-            'filename': filename
+            'filename': filename,
+            'size': writer.size,
+            'sha256': sha256
         }), 200
         
     except Exception as e:
@@ -703,74 +1441,1146 @@ def upload_video(packaging_id):
         traceback.print_exc()
         return jsonify({'message': f'Error uploading video: {str(e)}'}), 500
 
-# ==================== VIDEO SERVING ENDPOINTS ====================
+    finally:
+        # Whatever wasn't renamed into place
+        for writer in writers:
+            writer.file.close()
+            if os.path.exists(writer.path):
+                os.remove(writer.path)
+
+def finish_chunked_upload(packaging_id, upload_id, filename, part_path, done_path, expected=None):
+    """Attach a fully received chunked upload to its packaging record"""
+    sha256 = file_sha256(part_path)
+    if expected and expected != sha256:
+        # The bytes held don't match what the client has; start over
+        os.remove(part_path)
+        return jsonify({'message': 'Checksum mismatch', 'offset': 0, 'sha256': sha256}), 400
+
+    conn = get_db_connection()
+    try:
+        # The .part file stays put until the record update is ready to
+        # commit, so a failed attach can be retried from the bytes held
+        video_path = attach_video(conn, packaging_id, sha256, part_path,
+                                  os.path.splitext(filename)[1].lower())
+        if video_path is False:
+            archived = is_archived(conn.cursor(), packaging_id)
+            if archived:
+                return jsonify({'message': ARCHIVED_MESSAGE}), 410
+            return jsonify({'message': 'Packaging record not found'}), 404
+    finally:
+        conn.close()
+    print(f"[UPLOAD] Chunked upload {upload_id} saved to: {video_path}")
+    queue_thumbnails(sha256, video_path)
+    # Only now is the upload really done; a client that missed this reply
+    # is told so instead of resending the file
+    open(done_path, 'w').close()
+
+    return jsonify({
+        'message': 'Video uploaded successfully',
+        'complete': True,
+        'offset': os.path.getsize(video_path),
+        'video_path': video_path,
+        'filename': os.path.basename(video_path),
+        'sha256': sha256
+    }), 200
+
+@app.route('/api/packaging/upload-chunk/<int:packaging_id>', methods=['GET', 'POST'])
+def upload_video_chunk(packaging_id):
+    """Resumable chunked upload.
+
+    GET reports how many bytes of `upload_id` the server holds. POST appends
+    the raw request body at `offset`; a mismatched offset gets 409 with the
+    offset to resume from. Once all `total` bytes are held the file is
+    attached to the record exactly like /api/packaging/upload-video does,
+    and the reply carries "complete": true. If attaching failed earlier, a
+    GET or an empty POST at the end retries it.
+
+    Clients should pass the file's `sha256`: a GET for content the server
+    already stores attaches it straight away ("complete" with
+    "deduplicated": true, nothing sent), and the assembled file is
+    checked against it.
+    """
+    upload_id = request.args.get('upload_id', '')
+    filename = secure_filename(request.args.get('filename', ''))
+    sha256 = request.args.get('sha256', '').lower() or None
+    try:
+        total = int(request.args.get('total', ''))
+    except ValueError:
+        return jsonify({'message': 'total is required'}), 400
+
+    if not UPLOAD_ID_RE.match(upload_id):
+        return jsonify({'message': 'Invalid upload_id'}), 400
+    if sha256 and not SHA256_RE.match(sha256):
+        return jsonify({'message': 'Invalid sha256'}), 400
+    if not filename or not allowed_file(filename):
+        return jsonify({
+            'message': f'Invalid file type. Allowed types: {", ".join(ALLOWED_EXTENSIONS)}'
+        }), 400
 
-@app.route('/api/video/<int:packaging_id>')
-def stream_video(packaging_id):
+    part_path = os.path.join(PARTIAL_FOLDER, f"{upload_id}.part")
+    done_path = os.path.join(PARTIAL_FOLDER, f"{upload_id}.done")
+
+    try:
+        if os.path.exists(done_path):
+            return jsonify({'message': 'Upload already complete', 'complete': True,
+                            'offset': total}), 200
+        held = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+        if request.method == 'GET':
+            if total and held == total:
+                # Every byte arrived but attaching it failed last time
+                return finish_chunked_upload(packaging_id, upload_id, filename,
+                                             part_path, done_path, sha256)
+            if sha256:
+                conn = get_db_connection()
+                video_path = attach_video(conn, packaging_id, sha256)
+                conn.close()
+                if video_path:
+                    print(f"[UPLOAD] {upload_id}: server already has {sha256[:12]}, attached")
+                    queue_thumbnails(sha256, video_path)
+                    if os.path.exists(part_path):
+                        os.remove(part_path)
+                    open(done_path, 'w').close()
+                    return jsonify({'message': 'Video already stored', 'complete': True,
+                                    'deduplicated': True, 'offset': total,
+                                    'video_path': video_path}), 200
+            return jsonify({'offset': held}), 200
+
+        try:
+            offset = int(request.args.get('offset', -1))
+        except ValueError:
+            return jsonify({'message': 'Invalid offset', 'offset': held}), 400
+        if offset != held:
+            return jsonify({'message': 'Offset mismatch', 'offset': held}), 409
+
+        if held == 0:
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            cursor.execute("SELECT ws_id, video_size FROM tracking_table WHERE id = ?", (packaging_id,))
+            record = cursor.fetchone()
+            limit = station_quota_left(cursor, record['ws_id']) if record else None
+            conn.close()
+            if limit is not None and total > limit + (record['video_size'] or 0):
+                return jsonify({'message': 'Station storage quota exceeded', 'offset': held}), 413
+
+        chunk = request.get_data()
+        if held + len(chunk) > total:
+            return jsonify({'message': 'Chunk runs past total size', 'offset': held}), 400
+        with open(part_path, 'ab') as f:
+            f.write(chunk)
+        held += len(chunk)
+
+        if held < total or not total:
+            return jsonify({'message': 'Chunk stored', 'offset': held}), 200
+
+        return finish_chunked_upload(packaging_id, upload_id, filename,
+                                     part_path, done_path, sha256)
+
+    except Exception as e:
+        print(f"[UPLOAD ERROR] {str(e)}")
+        return jsonify({'message': f'Error uploading chunk: {str(e)}'}), 500
+
+# ==================== ARCHIVED PARTITIONS ====================
+
+def partition_sources(conn, start_date=None, end_date=None):
+    """Partitions a query has to read: 'main' plus matching archive paths.
+
+    An archived month is skipped when none of its rows can satisfy
+    start_time >= start_date and end_time <= end_date.
+    """
+    query = "SELECT path FROM tracking_partitions WHERE 1=1"
+    params = []
+    if start_date:
+        query += " AND start_max >= ?"
+        params.append(start_date)
+    if end_date:
+        query += " AND end_min <= ?"
+        params.append(end_date)
+    cursor = conn.cursor()
+    cursor.execute(query + " ORDER BY month DESC", params)
+    return ['main'] + [row['path'] for row in cursor.fetchall()]
+
+def attach_partition(conn, source):
+    """Attach an archive read-only on this connection; returns its schema name"""
+    if source == 'main':
+        return 'main'
+    schema = conn.attached.get(source)
+    if schema:
+        conn.attached.move_to_end(source)
+        return schema
+    if len(conn.attached) >= ARCHIVE_ATTACH_LIMIT:
+        _, old_schema = conn.attached.popitem(last=False)
+        conn.execute(f"DETACH DATABASE {old_schema}")
+    schema = 'arch_' + re.sub(r'\W', '_', os.path.splitext(os.path.basename(source))[0])
+    conn.execute(f"ATTACH DATABASE ? AS {schema}",
+                 (pathlib.Path(source).resolve().as_uri() + '?mode=ro',))
+    conn.attached[source] = schema
+    return schema
+
+def find_packaging(conn, packaging_id, columns='*'):
+    """Look a record up in the hot table, then in the archives.
+
+    Returns (row, archived); row is None if the id is unknown.
+    """
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT {columns} FROM tracking_table WHERE id = ?", (packaging_id,))
+    record = cursor.fetchone()
+    if record:
+        return record, False
+
+    cursor.execute("""
+        SELECT path FROM tracking_partitions WHERE ? BETWEEN min_id AND max_id
+    """, (packaging_id,))
+    for part in cursor.fetchall():
+        schema = attach_partition(conn, part['path'])
+        cursor.execute(f"SELECT {columns} FROM {schema}.tracking_table WHERE id = ?",
+                       (packaging_id,))
+        record = cursor.fetchone()
+        if record:
+            return record, True
+    return None, False
+
+def is_archived(cursor, packaging_id):
+    """Whether an id missing from the hot table was moved to an archive"""
+    cursor.execute("""
+        SELECT 1 FROM tracking_partitions WHERE ? BETWEEN min_id AND max_id LIMIT 1
+    """, (packaging_id,))
+    return cursor.fetchone() is not None
+
+def archive_month(month):
+    """Move a month's closed records into a fresh read-only archive file.
+
+    Rows for a month that is already archived (late syncs) are merged
+    with the existing archive into a new file. The archive is built in
+    batches from a read snapshot, so writers carry on meanwhile. Only
+    then is the hot table locked for writes: rows that changed or went
+    away since the snapshot are dropped from the archive and stay hot for
+    the next run, and the rest are deleted once the archive is durable
+    and registered.
+    """
+    first = f"{month}-01"
+    year, mon = int(month[:4]), int(month[5:7])
+    nxt = f"{year + mon // 12:04d}-{mon % 12 + 1:02d}-01"
+    path = os.path.join(ARCHIVE_FOLDER, f"tracking_{month.replace('-', '_')}_{int(time.time())}.db")
+    tmp_path = path + ".tmp"
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    arch = None
     try:
+        cursor.execute("SELECT path FROM tracking_partitions WHERE month = ?", (month,))
+        old = cursor.fetchone()
+        old_path = old['path'] if old else None
+        cursor.execute("""
+            SELECT sql FROM sqlite_master
+            WHERE tbl_name = 'tracking_table' AND type IN ('table', 'index') AND sql IS NOT NULL
+            ORDER BY type DESC
+        """)
+        schema_sql = [row['sql'] for row in cursor.fetchall()]
+
+        # Snapshot read: the month as of now, streamed into the archive
+        cursor.execute("BEGIN")
+        cursor.execute("""
+            SELECT * FROM tracking_table
+            WHERE start_time >= ? AND start_time < ? AND end_time IS NOT NULL
+        """, (first, nxt))
+        rows = cursor.fetchmany(ARCHIVE_BATCH)
+        if not rows:
+            conn.rollback()
+            return 0
+
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        arch = sqlite3.connect(tmp_path)
+        arch.executescript(";\n".join(schema_sql))
+        if old_path:
+            arch.execute("ATTACH DATABASE ? AS old",
+                         (pathlib.Path(old_path).resolve().as_uri() + '?mode=ro',))
+            # An older archive may predate columns added since
+            columns = ', '.join(row[1] for row in arch.execute("PRAGMA old.table_info(tracking_table)"))
+            arch.execute(f"INSERT INTO tracking_table ({columns}) SELECT {columns} FROM old.tracking_table")
+            arch.commit()
+            arch.execute("DETACH DATABASE old")
+        insert = f"INSERT OR REPLACE INTO tracking_table VALUES ({', '.join('?' * len(rows[0]))})"
+        copied = array('q')
+        while rows:
+            arch.executemany(insert, (tuple(r) for r in rows))
+            copied.extend(r['id'] for r in rows)
+            rows = cursor.fetchmany(ARCHIVE_BATCH)
+        conn.rollback()
+        arch.commit()
+        arch.execute("VACUUM")
+
+        # Short write lock: keep only rows still exactly as copied
+        cursor.execute("BEGIN IMMEDIATE")
+        moving, stale = array('q'), []
+        for i in range(0, len(copied), ARCHIVE_BATCH):
+            ids = copied[i:i + ARCHIVE_BATCH]
+            marks = ', '.join('?' * len(ids))
+            cursor.execute(f"SELECT * FROM tracking_table WHERE id IN ({marks})", ids)
+            current = {r['id']: tuple(r) for r in cursor.fetchall()}
+            archived = {r[0]: r for r in arch.execute(
+                f"SELECT * FROM tracking_table WHERE id IN ({marks})", ids)}
+            for packaging_id in ids:
+                if current.get(packaging_id, False) == archived.get(packaging_id):
+                    moving.append(packaging_id)
+                else:
+                    stale.append((packaging_id,))
+        if not moving:
+            conn.rollback()
+            return 0
+        if stale:
+            arch.executemany("DELETE FROM tracking_table WHERE id = ?", stale)
+            arch.commit()
+        stats = arch.execute("""
+            SELECT COUNT(*), MIN(id), MAX(id), MAX(start_time), MIN(end_time) FROM tracking_table
+        """).fetchone()
+        arch.close()
+        arch = None
+        os.chmod(tmp_path, 0o444)
+        os.replace(tmp_path, path)
+
+        cursor.executemany("DELETE FROM tracking_table WHERE id = ?",
+                           ((packaging_id,) for packaging_id in moving))
+        cursor.execute("""
+            INSERT INTO gc_state (key, value) VALUES ('archive_generation', 1)
+            ON CONFLICT(key) DO UPDATE SET value = value + 1
+        """)
+        cursor.execute("""
+            INSERT OR REPLACE INTO tracking_partitions
+                (month, path, row_count, min_id, max_id, start_max, end_min)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (month, path) + tuple(stats))
+        conn.commit()
+    finally:
+        if arch is not None:
+            arch.close()
+        conn.close()
+
+    print(f"[ARCHIVE] {month}: moved {len(moving)} records to {path}"
+          + (f", {len(stale)} changed meanwhile and stay hot" if stale else ""))
+    if old_path:
+        try:
+            os.chmod(old_path, 0o644)
+            os.remove(old_path)
+        except OSError:
+            pass    # still open somewhere; swept on a later run
+    return len(moving)
+
+def run_archival():
+    """Archive every closed month older than ARCHIVE_AFTER_DAYS, then compact"""
+    cutoff = (datetime.date.today() - datetime.timedelta(days=ARCHIVE_AFTER_DAYS)).replace(day=1)
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT DISTINCT substr(start_time, 1, 7) AS month FROM tracking_table
+        WHERE start_time < ? AND end_time IS NOT NULL
+    """, (cutoff.isoformat(),))
+    months = [row['month'] for row in cursor.fetchall()
+              if re.match(r'^\d{4}-\d{2}$', row['month'] or '')]
+    cursor.execute("SELECT path FROM tracking_partitions")
+    registered = {os.path.abspath(row['path']) for row in cursor.fetchall()}
+    conn.close()
+
+    # Leftovers from interrupted runs and superseded archives
+    for name in os.listdir(ARCHIVE_FOLDER):
+        leftover = os.path.abspath(os.path.join(ARCHIVE_FOLDER, name))
+        if leftover not in registered and time.time() - os.path.getmtime(leftover) > 3600:
+            try:
+                os.chmod(leftover, 0o644)
+                os.remove(leftover)
+            except OSError:
+                pass
+
+    moved = sum(archive_month(month) for month in sorted(months))
+    if moved:
+        conn = get_db_connection()
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        free, pages = (conn.execute(f"PRAGMA {p}").fetchone()[0]
+                       for p in ("freelist_count", "page_count"))
+        if free * 4 > pages:
+            conn.execute("VACUUM")
+        conn.close()
+    return moved
+
+def archive_worker():
+    while True:
+        try:
+            run_archival()
+        except Exception as e:
+            print(f"[ARCHIVE ERROR] {str(e)}")
+        time.sleep(ARCHIVE_INTERVAL)
+
+# ==================== VIDEO TIERING ====================
+
+def transcode_video(src, dst):
+    """Re-encode `src` into `dst`; keeps a plain copy when that isn't smaller"""
+    if FFMPEG:
+        result = subprocess.run([FFMPEG, "-nostdin", "-y", "-loglevel", "error", "-i", src]
+                                + TRANSCODE_ARGS + ["-f", "mp4", dst],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                timeout=TRANSCODE_TIMEOUT)
+        if result.returncode == 0 and os.path.getsize(dst) < os.path.getsize(src):
+            return True
+        if result.returncode != 0:
+            print(f"[TIER] ffmpeg failed for {src}: {result.stderr.decode(errors='replace')[-300:]}")
+    shutil.copyfile(src, dst)
+    return False
+
+_adopt_after_id = 0
+
+def adopt_legacy_videos(limit):
+    """Bring files stored before the content-addressed store under video_blobs"""
+    global _adopt_after_id
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT id, ws_id, video_path FROM tracking_table
+        WHERE id > ? AND video_path IS NOT NULL AND video_sha256 IS NULL
+        ORDER BY id LIMIT ?
+    """, (_adopt_after_id, limit))
+    rows = cursor.fetchall()
+    conn.close()
+    # Walk the table a batch per run, so missing files can't stall it
+    _adopt_after_id = rows[-1]['id'] if len(rows) == limit else 0
+
+    for row in rows:
+        if not os.path.exists(row['video_path']):
+            continue
+        sha256 = file_sha256(row['video_path'])
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute("SELECT video_path FROM tracking_table WHERE id = ?", (packaging_id,))
-        record = cursor.fetchone()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("SELECT video_path FROM tracking_table WHERE id = ?", (row['id'],))
+        current = cursor.fetchone()
+        cursor.execute("SELECT path, size, tier, ws_id FROM video_blobs WHERE sha256 = ?", (sha256,))
+        blob = cursor.fetchone()
+        stale = None
+        if current and current['video_path'] == row['video_path']:
+            if blob and blob['tier'] == 'hot':
+                # Same bytes already stored; drop this copy
+                cursor.execute("UPDATE video_blobs SET refcount = refcount + 1 WHERE sha256 = ?", (sha256,))
+                stale, path = row['video_path'], blob['path']
+            else:
+                path, size = row['video_path'], os.path.getsize(row['video_path'])
+                if blob:
+                    # This original replaces a cold transcode or revives a purged blob
+                    stale = blob['path']
+                    add_station_usage(cursor, blob['ws_id'], -(blob['size'] or 0))
+                cursor.execute("""
+                    INSERT INTO video_blobs (sha256, path, size, refcount, ws_id, doa)
+                    VALUES (?, ?, ?, 1, ?, datetime(?, 'unixepoch'))
+                    ON CONFLICT(sha256) DO UPDATE SET path = excluded.path, size = excluded.size,
+                        refcount = refcount + 1, tier = 'hot', ws_id = excluded.ws_id,
+                        doa = excluded.doa
+                """, (sha256, path, size, row['ws_id'], int(os.path.getmtime(path))))
+                add_station_usage(cursor, row['ws_id'], size)
+            cursor.execute("UPDATE tracking_table SET video_path = ?, video_sha256 = ? WHERE id = ?",
+                           (path, sha256, row['id']))
+        conn.commit()
         conn.close()
+        remove_video_file(stale)
 
-        if not record or not record['video_path']:
-            return jsonify({'message': 'Video not found'}), 404
+def move_to_cold(sha256, src):
+    """Transcode one stored video into the cold tier and repoint it"""
+    dst = os.path.join(COLD_FOLDER, sha256[:2], sha256[2:4], sha256 + ".mp4")
+    tmp = dst + ".tmp"
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        transcoded = transcode_video(src, tmp)
+        os.replace(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("SELECT path, size, ws_id FROM video_blobs WHERE sha256 = ?", (sha256,))
+        blob = cursor.fetchone()
+        if not blob or blob['path'] != src:
+            # Deleted or moved while we worked
+            conn.rollback()
+            if not blob or blob['path'] != dst:
+                os.remove(dst)
+            return 0
+        size = os.path.getsize(dst)
+        cursor.execute("UPDATE video_blobs SET path = ?, size = ?, tier = 'cold' WHERE sha256 = ?",
+                       (dst, size, sha256))
+        add_station_usage(cursor, blob['ws_id'], size - (blob['size'] or 0))
+        # Archived rows can't be rewritten; readers resolve them through video_blobs
+        cursor.execute("UPDATE tracking_table SET video_path = ? WHERE video_sha256 = ?",
+                       (dst, sha256))
+        conn.commit()
+    finally:
+        conn.close()
 
-        video_path = os.path.normpath(record['video_path'])
+    saved = os.path.getsize(src) - size
+    remove_video_file(src)
+    print(f"[TIER] {sha256[:12]} -> cold ({'transcoded' if transcoded else 'copied'}, {saved} bytes saved)")
+    return saved
 
-        if not os.path.exists(video_path):
-            return jsonify({'message': 'Video file missing'}), 404
+def run_tiering():
+    """Move stored videos older than TIER_AFTER_DAYS to the cold tier"""
+    adopt_legacy_videos(TIER_BATCH)
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT sha256, path FROM video_blobs
+        WHERE tier = 'hot' AND doa < datetime('now', ?)
+        ORDER BY doa LIMIT ?
+    """, (f'-{TIER_AFTER_DAYS} days', TIER_BATCH))
+    blobs = [(row['sha256'], row['path']) for row in cursor.fetchall()]
+    conn.close()
+
+    # Each thread drives one ffmpeg process
+    with ThreadPoolExecutor(max_workers=TRANSCODE_WORKERS) as pool:
+        return sum(pool.map(lambda blob: _try_move_to_cold(*blob), blobs))
+
+def _try_move_to_cold(sha256, src):
+    try:
+        return move_to_cold(sha256, src) if os.path.exists(src) else 0
+    except Exception as e:
+        print(f"[TIER ERROR] {sha256[:12]}: {str(e)}")
+        return 0
 
-        file_size = os.path.getsize(video_path)
-        range_header = request.headers.get('Range')
+def tiering_worker():
+    while True:
+        try:
+            run_tiering()
+        except Exception as e:
+            print(f"[TIER ERROR] {str(e)}")
+        time.sleep(TIER_INTERVAL)
 
-        def generate(start, length):
-            with open(video_path, "rb") as f:
-                f.seek(start)
-                remaining = length
-                chunk_size = 8192
+# ==================== RETENTION & GARBAGE COLLECTION ====================
+
+LEGACY_VIDEO_RE = re.compile(r'^packaging_(\d+)_')
+_gc_lock = threading.Lock()
+
+def get_gc_state(cursor, key, default):
+    cursor.execute("SELECT value FROM gc_state WHERE key = ?", (key,))
+    row = cursor.fetchone()
+    return row['value'] if row else default
+
+def set_gc_state(cursor, key, value):
+    cursor.execute("""
+        INSERT INTO gc_state (key, value) VALUES (?, ?)
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value
+    """, (key, str(value)))
+
+def gc_remove(path, report, kind):
+    """Delete one file the scan found unreferenced; counts it in `report`"""
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+    except OSError as e:
+        print(f"[GC] Failed to delete {path}: {str(e)}")
+        return
+    report[f'{kind}_files'] += 1
+    report[f'{kind}_bytes'] += size
+    print(f"[GC] Deleted {kind} file {path} ({size} bytes)")
+
+def purge_blob(conn, sha256):
+    """Delete a stored video for every record using it; returns bytes freed.
+
+    Hot records lose their video. Archived records can't be rewritten, so
+    the blob row stays behind as 'purged' and resolves them to nothing.
+    """
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    cursor.execute("SELECT path, size, ws_id FROM video_blobs WHERE sha256 = ?", (sha256,))
+    blob = cursor.fetchone()
+    if not blob or blob['path'] is None:
+        conn.rollback()
+        return 0
+    cursor.execute("""
+        UPDATE video_blobs SET path = NULL, size = 0, refcount = 0, tier = 'purged'
+        WHERE sha256 = ?
+    """, (sha256,))
+    cursor.execute("""
+        UPDATE tracking_table SET video_path = NULL, video_size = NULL, video_sha256 = NULL
+        WHERE video_sha256 = ?
+    """, (sha256,))
+    add_station_usage(cursor, blob['ws_id'], -(blob['size'] or 0))
+    conn.commit()
+    if os.path.exists(blob['path']):
+        os.remove(blob['path'])
+    print(f"[GC] Retention purged {sha256[:12]} ({blob['size']} bytes)")
+    return blob['size'] or 0
+
+def rebuild_station_usage(conn):
+    """Recount stored bytes per station from video_blobs, so drift can't build up"""
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    cursor.execute("DELETE FROM station_usage")
+    cursor.execute("""
+        INSERT INTO station_usage (ws_id, bytes)
+        SELECT ws_id, SUM(size) FROM video_blobs
+        WHERE ws_id IS NOT NULL AND path IS NOT NULL
+        GROUP BY ws_id
+    """)
+    conn.commit()
+
+def apply_retention(conn, report):
+    """Purge each station's videos past its age limit, then its oldest
+    videos until it is back under its size limit"""
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, retention_days, retention_max_mb FROM workstation")
+    stations = cursor.fetchall()
+
+    for station in stations:
+        days = station['retention_days'] if station['retention_days'] is not None else RETENTION_DAYS
+        max_mb = station['retention_max_mb'] if station['retention_max_mb'] is not None else RETENTION_MAX_MB
+        if not days and not max_mb:
+            continue
+
+        excess = 0
+        if max_mb:
+            cursor.execute("SELECT bytes FROM station_usage WHERE ws_id = ?", (station['id'],))
+            row = cursor.fetchone()
+            excess = (row['bytes'] if row else 0) - max_mb * 1024 * 1024
+        cursor.execute("""
+            SELECT sha256, size, doa < datetime('now', ?) AS expired FROM video_blobs
+            WHERE ws_id = ? AND path IS NOT NULL
+            ORDER BY doa LIMIT ?
+        """, (f'-{days or 0} days', station['id'], GC_BATCH))
+        for blob in cursor.fetchall():
+            if not (days and blob['expired']) and excess <= 0:
+                break
+            freed = purge_blob(conn, blob['sha256'])
+            excess -= freed
+            report['purged_files'] += 1 if freed else 0
+            report['purged_bytes'] += freed
+
+def scan_store_shards(conn, report):
+    """Check the next GC_SHARDS_PER_RUN store/ab/ directories of both tiers
+    against video_blobs: unreferenced files are deleted, blobs whose file
+    is gone are reported, and thumbnails of videos no longer stored are
+    deleted. A full pass takes 256 / GC_SHARDS_PER_RUN runs."""
+    cursor = conn.cursor()
+    first = int(get_gc_state(cursor, 'store_shard', 0))
+    shards = [f"{(first + i) % 256:02x}" for i in range(GC_SHARDS_PER_RUN)]
+    cutoff = time.time() - GC_GRACE
+
+    for shard in shards:
+        # Hex digits sort below 'g', so this covers every sha256 in the shard
+        cursor.execute("""
+            SELECT sha256, path FROM video_blobs
+            WHERE sha256 >= ? AND sha256 < ? AND path IS NOT NULL
+        """, (shard, shard + 'g'))
+        known = {row['path']: row['sha256'] for row in cursor.fetchall()}
+
+        candidates = []
+        for root in (VIDEO_STORE, COLD_FOLDER):
+            for dirpath, _, names in os.walk(os.path.join(root, shard)):
+                for name in names:
+                    path = os.path.join(dirpath, name)
+                    if path not in known and os.path.getmtime(path) < cutoff:
+                        candidates.append((name.split('.', 1)[0], path))
+        live = set(known.values())
+        for dirpath, _, names in os.walk(os.path.join(THUMB_FOLDER, shard)):
+            for name in names:
+                path = os.path.join(dirpath, name)
+                if name.split('.', 1)[0] not in live and os.path.getmtime(path) < cutoff:
+                    candidates.append((name.split('.', 1)[0], path))
+        for path, sha256 in known.items():
+            if not os.path.exists(path):
+                report['missing_files'] += 1
+                print(f"[GC] Video {sha256[:12]} is missing its file {path}")
+
+        for sha256, path in candidates:
+            # Re-check under the write lock: an upload may have just landed
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("SELECT path FROM video_blobs WHERE sha256 = ?", (sha256,))
+            blob = cursor.fetchone()
+            if path.startswith(THUMB_FOLDER):
+                orphan = not blob or blob['path'] is None
+            else:
+                orphan = not blob or blob['path'] != path
+            if orphan:
+                gc_remove(path, report, 'orphan')
+            conn.rollback()
+
+    set_gc_state(cursor, 'store_shard', (first + GC_SHARDS_PER_RUN) % 256)
+    conn.commit()
+
+def scan_legacy_videos(conn, report):
+    """Check the next GC_BATCH files stored flat in the upload folder (before
+    the content-addressed store) and delete those no record points at.
+
+    Nothing new is stored flat any more, so the folder only shrinks. The
+    cursor is a position in directory order: each run reads on from there
+    without sorting or stat-ing the rest, and once a pass reaches the end
+    the next one starts GC_LEGACY_RESCAN later.
+    """
+    cursor = conn.cursor()
+    pos = int(get_gc_state(cursor, 'legacy_pos', 0))
+    if not pos and time.time() - float(get_gc_state(cursor, 'legacy_pass', 0)) < GC_LEGACY_RESCAN:
+        return
+    cutoff = time.time() - GC_GRACE
+
+    checked = removed = 0
+    finished = True
+    with os.scandir(UPLOAD_FOLDER) as entries:
+        for index, entry in enumerate(entries):
+            if index < pos:
+                continue
+            if checked == GC_BATCH:
+                finished = False
+                break
+            if not entry.is_file() or not LEGACY_VIDEO_RE.match(entry.name):
+                continue
+            checked += 1
+            if entry.stat().st_mtime >= cutoff:
+                continue
+            record, _ = find_packaging(conn, int(LEGACY_VIDEO_RE.match(entry.name).group(1)),
+                                       'video_path, video_sha256')
+            path = os.path.join(UPLOAD_FOLDER, entry.name)
+            referenced = record is not None and record['video_path'] == path
+            if record is not None and not referenced and record['video_sha256']:
+                # Adopted by the store in place
+                cursor.execute("SELECT path FROM video_blobs WHERE sha256 = ?", (record['video_sha256'],))
+                blob = cursor.fetchone()
+                referenced = blob is not None and blob['path'] == path
+            if not referenced:
+                gc_remove(path, report, 'orphan')
+                removed += 1
+
+    if finished:
+        set_gc_state(cursor, 'legacy_pos', 0)
+        set_gc_state(cursor, 'legacy_pass', time.time())
+    else:
+        # Files deleted in this slice no longer take up a position
+        set_gc_state(cursor, 'legacy_pos', index - removed)
+    conn.commit()
+
+def sweep_partial_uploads(report):
+    """Delete uploads that were abandoned part-way, and old completion markers"""
+    now = time.time()
+    for entry in os.scandir(PARTIAL_FOLDER):
+        if not entry.is_file():
+            continue
+        # Streamed uploads are written continuously; chunked ones may resume later
+        max_age = GC_GRACE if entry.name.endswith('.upload') else PARTIAL_MAX_AGE
+        if entry.stat().st_mtime < now - max_age:
+            gc_remove(entry.path, report, 'partial')
+
+def sweep_live_streams(conn, report):
+    """Delete live segments of streams idle for LIVE_KEEP_HOURS; by then
+    the finished video has long replaced them"""
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT packaging_id FROM live_streams WHERE updated < datetime('now', ?) LIMIT ?
+    """, (f'-{LIVE_KEEP_HOURS} hours', GC_BATCH))
+    for row in cursor.fetchall():
+        folder = live_dir(row['packaging_id'])
+        if os.path.isdir(folder):
+            for entry in os.scandir(folder):
+                gc_remove(entry.path, report, 'live')
+            os.rmdir(folder)
+        cursor.execute("DELETE FROM live_segments WHERE packaging_id = ?", (row['packaging_id'],))
+        cursor.execute("DELETE FROM live_streams WHERE packaging_id = ?", (row['packaging_id'],))
+        conn.commit()
+
+def run_gc():
+    """Apply retention and reconcile the video folders with the database.
+
+    Each run does a bounded slice of the work, so it is cheap to run often.
+    Returns a report of what was deleted and how many bytes that freed.
+    """
+    report = dict.fromkeys(('purged_files', 'purged_bytes', 'orphan_files', 'orphan_bytes',
+                            'partial_files', 'partial_bytes', 'live_files', 'live_bytes',
+                            'missing_files'), 0)
+    with _gc_lock:
+        conn = get_db_connection()
+        try:
+            rebuild_station_usage(conn)
+            apply_retention(conn, report)
+            scan_store_shards(conn, report)
+            scan_legacy_videos(conn, report)
+            sweep_partial_uploads(report)
+            sweep_live_streams(conn, report)
+        finally:
+            conn.close()
+
+    report['reclaimed_bytes'] = (report['purged_bytes'] + report['orphan_bytes']
+                                 + report['partial_bytes'] + report['live_bytes'])
+    print(f"[GC] Reclaimed {report['reclaimed_bytes']} bytes "
+          f"({report['purged_files']} purged, {report['orphan_files']} orphaned, "
+          f"{report['partial_files']} partial, {report['live_files']} live, "
+          f"{report['missing_files']} missing)")
+    return report
+
+def gc_worker():
+    while True:
+        try:
+            run_gc()
+        except Exception as e:
+            print(f"[GC ERROR] {str(e)}")
+        time.sleep(GC_INTERVAL)
+
+@app.route('/api/storage/gc', methods=['POST'])
+@token_required
+def storage_gc(current_user_id):
+    """Run retention and garbage collection now and report what was reclaimed"""
+    try:
+        return jsonify(run_gc()), 200
+    except Exception as e:
+        return jsonify({'message': f'Error collecting garbage: {str(e)}'}), 500
+
+def start_background_jobs():
+    """Archival, tiering and GC threads; run them in one process only"""
+    threading.Thread(target=archive_worker, daemon=True).start()
+    threading.Thread(target=tiering_worker, daemon=True).start()
+    threading.Thread(target=gc_worker, daemon=True).start()
+
+# ==================== THUMBNAILS ====================
+
+thumb_pool = ThreadPoolExecutor(max_workers=THUMB_WORKERS)
+_thumbs_pending = set()
+_thumbs_lock = threading.Lock()
+
+def thumb_paths(sha256):
+    base = os.path.join(THUMB_FOLDER, sha256[:2], sha256)
+    return {'poster': base + ".jpg", 'sprite': base + ".sprite.jpg"}
+
+def video_duration(path):
+    """Length in seconds from ffmpeg's stream info, or None"""
+    result = subprocess.run([FFMPEG, "-nostdin", "-hide_banner", "-i", path],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=60)
+    match = re.search(rb"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", result.stderr)
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+def make_thumbnails(sha256, src):
+    """Extract the poster frame and the scrub strip of one stored video"""
+    paths = thumb_paths(sha256)
+    os.makedirs(os.path.dirname(paths['poster']), exist_ok=True)
+    duration = video_duration(src) or 0
+    jobs = (
+        # A tenth of the way in, past any dark lead-in
+        (paths['poster'], ["-ss", f"{duration / 10:.2f}", "-i", src,
+                           "-vf", f"scale={THUMB_WIDTH}:-2"]),
+        (paths['sprite'], ["-i", src,
+                           "-vf", f"fps={SPRITE_FRAMES / max(duration, 1):.6f},"
+                                  f"scale={SPRITE_WIDTH}:-2,tile={SPRITE_FRAMES}x1"]),
+    )
+    for dst, args in jobs:
+        tmp = dst + ".tmp"
+        try:
+            result = subprocess.run([FFMPEG, "-nostdin", "-y", "-loglevel", "error"] + args
+                                    + ["-frames:v", "1", "-q:v", "5", "-f", "mjpeg", tmp],
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                    timeout=TRANSCODE_TIMEOUT)
+            if result.returncode != 0 or not os.path.getsize(tmp):
+                print(f"[THUMB] ffmpeg failed for {src}: {result.stderr.decode(errors='replace')[-300:]}")
+                return
+            os.replace(tmp, dst)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    print(f"[THUMB] {sha256[:12]} thumbnails ready")
+
+def _make_thumbnails_job(sha256, src):
+    try:
+        make_thumbnails(sha256, src)
+    except Exception as e:
+        print(f"[THUMB ERROR] {sha256[:12]}: {str(e)}")
+    finally:
+        with _thumbs_lock:
+            _thumbs_pending.discard(sha256)
+
+def queue_thumbnails(sha256, video_path):
+    """Have the thumbnail workers extract a video's poster and strip, once per content"""
+    if not FFMPEG or os.path.exists(thumb_paths(sha256)['sprite']):
+        return
+    with _thumbs_lock:
+        if sha256 in _thumbs_pending:
+            return
+        _thumbs_pending.add(sha256)
+    thumb_pool.submit(_make_thumbnails_job, sha256, video_path)
+
+@app.route('/api/video/<int:packaging_id>/thumbnail')
+def video_thumbnail(packaging_id):
+    """Poster frame of a record's video as JPEG.
+
+    `kind=sprite` returns SPRITE_FRAMES frames spread over the video side
+    by side, for scrubbing on hover. Thumbnails are kept per content, so
+    with `v=<video_sha256>` (as in the list API) the URL never changes
+    meaning and is cached for THUMB_MAX_AGE; otherwise clients revalidate.
+    Videos uploaded before thumbnails existed get theirs on first request
+    (404 until ready).
+    """
+    kind = request.args.get('kind', 'poster')
+    if kind not in ('poster', 'sprite'):
+        return jsonify({'message': 'kind must be poster or sprite'}), 400
+    try:
+        conn = get_db_connection()
+        record, _ = find_packaging(conn, packaging_id, 'video_path, video_sha256')
+        video_path = resolve_video_path(conn, record) if record else None
+        conn.close()
+
+        if not video_path or not record['video_sha256']:
+            return jsonify({'message': 'Thumbnail not available'}), 404
+        sha256 = record['video_sha256']
+        path = thumb_paths(sha256)[kind]
+        if not os.path.exists(path):
+            if os.path.exists(video_path):
+                queue_thumbnails(sha256, video_path)
+            return jsonify({'message': 'Thumbnail not ready'}), 404
+
+        versioned = request.args.get('v') == sha256
+        response = send_file(os.path.abspath(path), mimetype='image/jpeg', etag=f"{sha256}-{kind}",
+                             conditional=True, max_age=THUMB_MAX_AGE if versioned else None)
+        response.cache_control.immutable = versioned or None
+        return response
+
+    except Exception as e:
+        return jsonify({'message': f'Error loading thumbnail: {str(e)}'}), 500
+
+# ==================== LIVE STREAMING ====================
 
+def live_dir(packaging_id):
+    return os.path.join(LIVE_FOLDER, str(packaging_id))
+
+@app.route('/api/packaging/live/<int:packaging_id>/segment', methods=['POST'])
+def upload_live_segment(packaging_id):
+    """Store one MPEG-TS segment of a recording still in progress.
+
+    Stations push `seq` 0, 1, 2... with each segment's `duration` in
+    seconds as the raw request body. A resent segment replaces the
+    earlier copy. The finished video still arrives through the normal
+    upload; live segments are only for watching while it is made.
+    """
+    try:
+        seq = int(request.args.get('seq', ''))
+        duration = float(request.args.get('duration', ''))
+    except ValueError:
+        return jsonify({'message': 'seq and duration are required'}), 400
+    if seq < 0 or not 0 < duration <= LIVE_MAX_SEGMENT:
+        return jsonify({'message': 'Invalid seq or duration'}), 400
+
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM tracking_table WHERE id = ?", (packaging_id,))
+        if not cursor.fetchone():
+            archived = is_archived(cursor, packaging_id)
+            conn.close()
+            if archived:
+                return jsonify({'message': ARCHIVED_MESSAGE}), 410
+            return jsonify({'message': 'Packaging record not found'}), 404
+
+        os.makedirs(live_dir(packaging_id), exist_ok=True)
+        path = os.path.join(live_dir(packaging_id), f"{seq}.ts")
+        tmp = path + ".tmp"
+        with open(tmp, 'wb') as f:
+            size = 0
+            for block in iter(lambda: request.stream.read(STREAM_CHUNK_MIN), b''):
+                f.write(block)
+                size += len(block)
+        os.replace(tmp, path)
+
+        cursor.execute("""
+            INSERT OR REPLACE INTO live_segments (packaging_id, seq, duration, size)
+            VALUES (?, ?, ?, ?)
+        """, (packaging_id, seq, duration, size))
+        cursor.execute("""
+            INSERT INTO live_streams (packaging_id) VALUES (?)
+            ON CONFLICT(packaging_id) DO UPDATE SET ended = 0, updated = CURRENT_TIMESTAMP
+        """, (packaging_id,))
+        conn.commit()
+        conn.close()
+        return jsonify({'message': 'Segment stored', 'seq': seq}), 200
+
+    except Exception as e:
+        print(f"[LIVE ERROR] {str(e)}")
+        return jsonify({'message': f'Error storing segment: {str(e)}'}), 500
+
+@app.route('/api/packaging/live/<int:packaging_id>/end', methods=['POST'])
+def end_live_stream(packaging_id):
+    """Mark a live stream finished, so players stop polling for segments"""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE live_streams SET ended = 1, updated = CURRENT_TIMESTAMP
+            WHERE packaging_id = ?
+        """, (packaging_id,))
+        found = cursor.rowcount
+        conn.commit()
+        conn.close()
+        if not found:
+            return jsonify({'message': 'No live stream for this packaging record'}), 404
+        return jsonify({'message': 'Live stream ended'}), 200
+
+    except Exception as e:
+        return jsonify({'message': f'Error ending live stream: {str(e)}'}), 500
+
+@app.route('/api/packaging/live/<int:packaging_id>/playlist.m3u8')
+def live_playlist(packaging_id):
+    """HLS playlist of a record's live segments.
+
+    An EVENT playlist: segments are only ever added, so a viewer can seek
+    back to the start of the package. It gets EXT-X-ENDLIST once the
+    station ends the stream. A gap left by a segment that never arrived
+    is marked as a discontinuity.
+    """
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT ended FROM live_streams WHERE packaging_id = ?", (packaging_id,))
+        stream = cursor.fetchone()
+        cursor.execute("""
+            SELECT seq, duration FROM live_segments WHERE packaging_id = ? ORDER BY seq
+        """, (packaging_id,))
+        segments = cursor.fetchall()
+        conn.close()
+
+        if not stream:
+            return jsonify({'message': 'No live stream for this packaging record'}), 404
+
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-PLAYLIST-TYPE:EVENT",
+                 f"#EXT-X-TARGETDURATION:{math.ceil(max([s['duration'] for s in segments], default=1))}",
+                 f"#EXT-X-MEDIA-SEQUENCE:{segments[0]['seq'] if segments else 0}"]
+        previous = None
+        for segment in segments:
+            if previous is not None and segment['seq'] != previous + 1:
+                lines.append("#EXT-X-DISCONTINUITY")
+            lines.append(f"#EXTINF:{segment['duration']:.3f},")
+            lines.append(f"{segment['seq']}.ts")
+            previous = segment['seq']
+        if stream['ended']:
+            lines.append("#EXT-X-ENDLIST")
+
+        response = Response("\n".join(lines) + "\n", mimetype="application/vnd.apple.mpegurl")
+        response.cache_control.no_cache = True
+        return response
+
+    except Exception as e:
+        return jsonify({'message': f'Error building playlist: {str(e)}'}), 500
+
+@app.route('/api/packaging/live/<int:packaging_id>/<int:seq>.ts')
+def live_segment(packaging_id, seq):
+    """One live segment; they never change once stored"""
+    path = os.path.join(live_dir(packaging_id), f"{seq}.ts")
+    if not os.path.exists(path):
+        return jsonify({'message': 'Segment not found'}), 404
+    return send_file(os.path.abspath(path), mimetype="video/mp2t", conditional=True,
+                     max_age=LIVE_KEEP_HOURS * 3600)
+
+# ==================== VIDEO SERVING ENDPOINTS ====================
+
+def stream_chunk_size(length):
+    """Bigger reads for bigger transfers, so long plays don't spin in Python"""
+    return max(STREAM_CHUNK_MIN, min(STREAM_CHUNK_MAX, length // 64))
+
+def byteranges_response(video_path, spans, file_size, etag, last_modified):
+    """multipart/byteranges reply for a request asking for several ranges"""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for i, (start, stop) in enumerate(spans):
+        head = (("\r\n" if i else "") + f"--{boundary}\r\n"
+                "Content-Type: video/mp4\r\n"
+                f"Content-Range: bytes {start}-{stop - 1}/{file_size}\r\n\r\n").encode()
+        parts.append((head, start, stop))
+    tail = f"\r\n--{boundary}--\r\n".encode()
+    length = sum(len(head) + stop - start for head, start, stop in parts) + len(tail)
+
+    def generate():
+        with open(video_path, "rb") as f:
+            for head, start, stop in parts:
+                yield head
+                f.seek(start)
+                remaining = stop - start
+                chunk_size = stream_chunk_size(remaining)
                 while remaining > 0:
                     chunk = f.read(min(chunk_size, remaining))
                     if not chunk:
                         break
                     remaining -= len(chunk)
                     yield chunk
+        yield tail
 
-        # No range → send full file
-        if not range_header:
-            return Response(
-                generate(0, file_size),
-                200,
-                mimetype="video/mp4",
-                headers={
-                    "Content-Length": str(file_size),
-                    "Accept-Ranges": "bytes"
-                }
-            )
-
-        # Parse range
-        byte1, byte2 = 0, None
-        match = range_header.replace("bytes=", "").split("-")
-
-        if match[0]:
-            byte1 = int(match[0])
-        if match[1]:
-            byte2 = int(match[1])
-
-        length = file_size - byte1 if byte2 is None else byte2 - byte1 + 1
-
-        return Response(
-            generate(byte1, length),
-            206,
-            mimetype="video/mp4",
-            headers={
-                "Content-Range": f"bytes {byte1}-{byte1+length-1}/{file_size}",
-                "Accept-Ranges": "bytes",
-                "Content-Length": str(length)
-            }
-        )
+    response = Response(generate(), 206, direct_passthrough=True,
+                        mimetype=f"multipart/byteranges; boundary={boundary}")
+    response.content_length = length
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.accept_ranges = "bytes"
+    return response
+
+@app.route('/api/video/<int:packaging_id>')
+def stream_video(packaging_id):
+    """Serve a record's video for the player.
+
+    The open file goes to the server's wsgi.file_wrapper, so servers with
+    sendfile support copy it without Python reading it. Range requests
+    (including suffix ranges, `bytes=-N`), If-Range and conditional
+    requests (ETag / Last-Modified -> 304) are handled; several ranges in
+    one request get a multipart/byteranges reply.
+    """
+    try:
+        conn = get_db_connection()
+        record, _ = find_packaging(conn, packaging_id)
+        video_path = resolve_video_path(conn, record) if record else None
+        conn.close()
+
+        if not video_path:
+            return jsonify({'message': 'Video not found'}), 404
+
+        video_path = os.path.normpath(video_path)
+
+        if not os.path.exists(video_path):
+            return jsonify({'message': 'Video file missing'}), 404
+
+        stat = os.stat(video_path)
+        file_size = stat.st_size
+        etag = f"{stat.st_mtime_ns:x}-{file_size:x}"
+        last_modified = datetime.datetime.fromtimestamp(int(stat.st_mtime), datetime.timezone.utc)
+
+        byte_range = request.range
+        if byte_range and len(byte_range.ranges) > 1:
+            if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+            if_range = request.if_range
+            if not ((if_range.etag and if_range.etag != etag) or
+                    (if_range.date and if_range.date != last_modified)):
+                spans = []
+                for start, stop in byte_range.ranges[:STREAM_MAX_RANGES]:
+                    if stop is None:
+                        stop = file_size
+                        if start < 0:
+                            start = max(file_size + start, 0)
+                    stop = min(stop, file_size)
+                    if start < stop:
+                        spans.append((start, stop))
+                if not spans:
+                    return RequestedRangeNotSatisfiable(length=file_size).get_response()
+                return byteranges_response(video_path, spans, file_size, etag, last_modified)
+
+        f = open(video_path, "rb")
+        response = Response(wrap_file(request.environ, f, stream_chunk_size(file_size)),
+                            mimetype="video/mp4", direct_passthrough=True)
+        response.content_length = file_size
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.accept_ranges = "bytes"
+        # A re-upload replaces the file behind the same URL, so revalidate
+        response.cache_control.no_cache = True
+        try:
+            return response.make_conditional(request, accept_ranges=True,
+                                             complete_length=file_size)
+        except RequestedRangeNotSatisfiable as e:
+            f.close()
+            return e.get_response()
 
     except Exception as e:
         import traceback
@@ -798,19 +2608,15 @@ def download_video(packaging_id):
                 pass  # Allow download without authentication for now
         
         conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT video_path FROM tracking_table WHERE id = ?", (packaging_id,))
-        record = cursor.fetchone()
+        record, _ = find_packaging(conn, packaging_id)
+        video_path = resolve_video_path(conn, record) if record else None
         conn.close()
         
         if not record:
             return jsonify({'message': 'Packaging record not found'}), 404
         
-        if not record['video_path']:
+        if not video_path:
             return jsonify({'message': 'No video associated with this packaging record'}), 404
-        
-        video_path = record['video_path']
         print(f"[DOWNLOAD] Requested path: {video_path}")
         
         # Try to find the file - handle both absolute and relative paths
@@ -844,32 +2650,34 @@ def delete_video(current_user_id, packaging_id):
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        cursor.execute("SELECT video_path FROM tracking_table WHERE id = ?", (packaging_id,))
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("SELECT * FROM tracking_table WHERE id = ?", (packaging_id,))
         record = cursor.fetchone()
         
         if not record:
+            archived = is_archived(cursor, packaging_id)
             conn.close()
+            if archived:
+                return jsonify({'message': ARCHIVED_MESSAGE}), 410
             return jsonify({'message': 'Packaging record not found'}), 404
         
         if not record['video_path']:
             conn.close()
             return jsonify({'message': 'No video associated with this packaging record'}), 404
         
-        video_path = record['video_path']
-        
-        # Delete file from filesystem
-        if os.path.exists(video_path):
-            os.remove(video_path)
+        # Delete the file once no other record shares it
+        stale = release_video(cursor, record)
         
         # Update database to remove video path
         cursor.execute("""
             UPDATE tracking_table 
-            SET video_path = NULL 
+            SET video_path = NULL, video_size = NULL, video_sha256 = NULL
             WHERE id = ?
         """, (packaging_id,))
         
         conn.commit()
         conn.close()
+        remove_video_file(stale)
         
         return jsonify({'message': 'Video deleted successfully'}), 200
         
@@ -881,10 +2689,123 @@ def health_check():
     """Health check endpoint"""
     return jsonify({'status': 'ok', 'message': 'API is running'}), 200
 
-def open_browser():
+# ==================== SERVER ====================
+
+def open_browser(port=SERVER_PORT):
     time.sleep(2)  # wait for server to start
-    webbrowser.open("http://localhost:27189/")
+    webbrowser.open(f"http://localhost:{port}/")
+
+def serve_waitress(args):
+    """Multi-threaded production server; works everywhere, including Windows"""
+    server = create_server(app, host=args.host, port=args.port, threads=args.threads,
+                           channel_timeout=args.timeout, connection_limit=args.threads * 32,
+                           ident='kapcher')
+    dispatcher = server.task_dispatcher
+
+    def busy():
+        return (dispatcher.active_count or dispatcher.queue or
+                any(getattr(ch, 'total_outbufs_len', 0) or getattr(ch, 'requests', None)
+                    for ch in list(server.active_channels.values())))
+
+    def drain():
+        deadline = time.time() + args.graceful_timeout
+        while busy() and time.time() < deadline:
+            time.sleep(0.2)
+        # Closing every channel empties the loop's map, which ends run()
+        try:
+            server.trigger.pull_trigger(lambda: wasyncore.close_all(server._map))
+        except OSError:
+            pass    # the loop woke for the previous thunk and already ran this one
+
+    def stop(signum, frame):
+        print("[SERVER] Shutting down, finishing open requests")
+        # Stop accepting, but keep the loop running so responses in
+        # flight (streams, uploads) can complete
+        server.trigger.pull_trigger(lambda: (server.del_channel(), server.socket.close()))
+        threading.Thread(target=drain, daemon=True).start()
+
+    for name in ('SIGINT', 'SIGTERM', 'SIGBREAK'):
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), stop)
+
+    print(f"[SERVER] waitress on {args.host}:{args.port}, {args.threads} threads")
+    server.run()
+    dispatcher.shutdown(timeout=args.graceful_timeout)
+
+BACKGROUND_LOCK = os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "background.lock")
+_background_lock = None
+
+def claim_background_jobs(server, worker):
+    """gunicorn post_fork hook: the first worker to lock BACKGROUND_LOCK runs
+    the background jobs. The lock dies with that worker, so whichever
+    worker replaces it takes over."""
+    global _background_lock
+    handle = open(BACKGROUND_LOCK, 'a')
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        return
+    _background_lock = handle
+    print(f"[SERVER] Background jobs run in worker {os.getpid()}")
+    start_background_jobs()
+
+def serve_gunicorn(args):
+    """Pre-fork server (POSIX only) so requests spread over every core"""
+
+    class KapcherServer(BaseApplication):
+        def load_config(self):
+            settings = {
+                'bind': f"{args.host}:{args.port}",
+                'workers': args.workers,
+                'worker_class': 'gthread',
+                'threads': args.threads,
+                'timeout': args.timeout,
+                'graceful_timeout': args.graceful_timeout,
+                'keepalive': SERVER_KEEPALIVE,
+                # Background jobs run in exactly one worker, never in the master
+                'post_fork': claim_background_jobs,
+            }
+            for key, value in settings.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    print(f"[SERVER] gunicorn on {args.host}:{args.port}, "
+          f"{args.workers} workers x {args.threads} threads")
+    KapcherServer().run()
 
 if __name__ == '__main__':
-    threading.Thread(target=open_browser).start()
-    app.run(debug=True, host='0.0.0.0', port=27189, use_reloader=False)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Kapcher server")
+    parser.add_argument('--production', action='store_true',
+                        help="serve with a multi-threaded production server instead of the debug server")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--workers', type=int, default=1,
+                        help="processes (needs gunicorn, not available on Windows); 0 = one per core")
+    parser.add_argument('--threads', type=int, default=SERVER_THREADS)
+    parser.add_argument('--timeout', type=int, default=SERVER_TIMEOUT)
+    parser.add_argument('--graceful-timeout', type=int, default=SERVER_GRACEFUL_TIMEOUT)
+    parser.add_argument('--no-browser', action='store_true')
+    args = parser.parse_args()
+    if args.workers == 0:
+        args.workers = os.cpu_count() or 1
+
+    if not args.no_browser:
+        threading.Thread(target=open_browser, args=(args.port,)).start()
+
+    if not args.production:
+        start_background_jobs()
+        app.run(debug=True, host=args.host, port=args.port, use_reloader=False)
+    elif args.workers > 1 and BaseApplication is not None and os_name != "Windows":
+        serve_gunicorn(args)
+    elif create_server is not None:
+        if args.workers > 1:
+            print("⚠ Multiple workers need gunicorn on Linux/macOS — using threads")
+        start_background_jobs()
+        serve_waitress(args)
+    else:
+        print("⚠ waitress is not installed (pip install waitress) — using the debug server")
+        start_background_jobs()
+        app.run(debug=False, host=args.host, port=args.port, threaded=True, use_reloader=False)
\ No newline at end of file